@@ -10,8 +10,13 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
 import file_utils as fu
 import utils as u
+import reference
+import bgzf
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
@@ -72,6 +77,21 @@ def binarySearchUniqueAndSorted(arg0, key):
     return -1 # NOT_FOUND
 
 
+"""First row of a lookup result, None when nothing matched
+"""
+def getFirst(rows):
+    if (len(rows) > 0):
+        return rows[0]
+    return None
+
+
+"""CpG island (chrom, chromStart, chromEnd, name) covering the position
+"""
+def getCpgIsland(ref_source, chr, pos):
+    return getFirst(ref_source.lookup('cpgIslandExt', chr, pos,
+        columns=('chrom', 'chromStart', 'chromEnd', 'name'), limit=1))
+
+
 """Cleans characters not accepted by MySQL
 """
 def clean_mysql_chars(entry):
@@ -107,1297 +127,1225 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
+"""Resolves a chunk of variants against dbSNP with one query per chromosome
+   variants is a list of (chr, pos, ref, compRef); returns one list of
+   matching rows per variant, in the order the database returned them
+"""
+def lookupDbSnpBatch(ref_source, variants, varclass='SNV'):
+    by_chr = {}
+    for (chr, pos, ref, compRef) in variants:
+        by_chr.setdefault(chr, set()).add(int(pos))
+
+    hits = {}
+    for chr, positions in by_chr.items():
+        hits[chr] = ref_source.lookup_batch('dbSNP', chr, positions,
+            where={'INFO': (varclass,)})
+
+    # REF is matched case-insensitively, as MySQL compared it
+    ref_ind = ref_source.column_index('dbSNP', 'REF')
+    results = []
+    for (chr, pos, ref, compRef) in variants:
+        refs = (str(ref).upper(), str(compRef).upper())
+        rows = []
+        for row in hits[chr].get(int(pos), []):
+            if (str(row[ref_ind]).upper() in refs):
+                rows.append(row)
+        results.append(rows)
+
+    return results
+
+
+"""Chromosome name without the "chr" prefix (dbSNP, chrom_pos_*, gadAll)
+"""
+def stripChr(chr):
+    if chr.startswith("chr"):
+        chr = chr.replace('chr', '')
+    return chr
 
-    inds = getFormatSpecificIndices(format=format)
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
-
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
-
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+"""Chromosome name with the "chr" prefix (UCSC tables)
+"""
+def addChr(chr):
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
+    return chr
+
+
+"""Base class for annotation stages
+   A stage first looks up the reference data for a Variant (lookup) and then
+   writes it into the variant's columns (apply); its counters end up in
+   .count.log
+   inputs are the VCF columns and INFO keys the stage reads, outputs the
+   ones it writes; they decide which stages may look up concurrently
+"""
+class Stage(object):
+    name = ''
+    inputs = ('CHROM', 'POS')
+    outputs = ()
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+    def __init__(self, format='vcf'):
+        self.inds = getFormatSpecificIndices(format=format)
+        self.counts = Counter()
+        self.ref_source = None
+        self.unsorted = set()
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+    def open(self):
+        self.ref_source = reference.connect()
 
-            linenum = linenum + 1
+    def close(self):
+        if self.ref_source is not None:
+            self.unsorted = reference.unsorted_tables(self.ref_source)
+            self.ref_source.close()
+            self.ref_source = None
 
-        else:
-            fh_out.write(line + '\n')
+    def lookup_chunk(self, chunk):
+        return [self.lookup(variant) for variant in chunk]
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+    def lookup(self, variant):
+        raise NotImplementedError
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    def apply(self, variant, result):
+        raise NotImplementedError
 
+    def write_log(self, fh_log):
+        pass
 
-"""NOTE: all isoforms are collapsed in one record
-    1. chrom_pos_equal_base
-    2. chrom_pos_equal_nobase
-    3. chrom_pos_unequal
+    """Identifies what the stage looks up; part of the variant cache key
+    """
+    def signature(self):
+        return f"{type(self).__name__}:{self.name}:{self.inds}"
+
+
+"""Stage adding the records of one table that overlap the variant
+   Logs "In <table>: <records> in <variants> variants"
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
-
-            if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                fh_out.write(line + '\n')
+class OverlapStage(Stage):
+    def __init__(self, table, format='vcf'):
+        Stage.__init__(self, format=format)
+        self.table = table
+        self.name = table
+        self.outputs = ('INFO.' + table,)
 
-            vcf_linenum = vcf_linenum + 1
+    def write_log(self, fh_log):
+        fh_log.write(f"In {str(self.name)}: {str(self.counts['var_count'])} in " + \
+            f"{str(self.counts['line_count'])} variants\n")
 
-        else:
-            fh_out.write(line + '\n')
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+"""Columns of a VCF data line that stages read or write; the FORMAT and
+   genotype columns after them are never looked at
+"""
+FIXED_COLUMNS = 8
+
+"""Splits a data line into its first FIXED_COLUMNS columns and, when there
+   are more, the rest of the line as one untouched string. Joining the
+   fields with tabs writes the genotype columns back as they were, without
+   splitting and joining hundreds of them per line
+"""
+def splitLine(line, sep='\t'):
+    fields = line.split(sep, FIXED_COLUMNS)
+    if (sep != '\t' and len(fields) > FIXED_COLUMNS):
+        fields[FIXED_COLUMNS] = fields[FIXED_COLUMNS].replace(sep, '\t')
+    return fields
+
+
+"""A VCF data line as stages see it
+   The chromosome with and without "chr", the position and REF and ALT
+   with their complements are normalized once, for all stages. Stages add
+   their INFO annotations as fragments, which are joined once, when the
+   line is written, instead of growing the INFO string by every stage
+"""
+class Variant(object):
+    __slots__ = ('fields', 'chrom', 'ucsc_chrom', 'pos', 'ref', 'alt',
+        'comp_ref', 'comp_alt', 'info')
+
+    def __init__(self, fields, inds):
+        self.fields = fields
+        chrom = fields[inds[0]].strip()
+        self.chrom = stripChr(chrom)
+        self.ucsc_chrom = addChr(chrom)
+        self.pos = int(fields[inds[1]].strip())
+        self.ref = fields[inds[2]].strip()
+        self.alt = fields[inds[3]].strip()
+        self.comp_ref = getComplementary(self.ref)
+        self.comp_alt = getComplementary(self.alt)
+        self.info = [fields[7]] if len(fields) > 7 else None
+
+    """INFO as it would be written now
+    """
+    def info_text(self):
+        text = ''.join(self.info)
+        self.info = [text]
+        return text
+
+    def set_info(self, text):
+        self.info = [text]
+
+    """Appends text to INFO as is
+    """
+    def add_info(self, text):
+        self.info.append(text)
+
+    """Appends an annotation to INFO, adding the ';' separator unless INFO
+       already ends with one
+    """
+    def append_info(self, text):
+        last = ''
+        for fragment in reversed(self.info):
+            if fragment:
+                last = fragment
+                break
+        if not last.endswith(';'):
+            self.info.append(';')
+        self.info.append(text)
+
+    """Puts a space after every tab of the line written so far
+    """
+    def space_columns(self):
+        fields = self.fields
+        for i in range(1, len(fields)):
+            if (i != 7):
+                fields[i] = ' ' + fields[i]
+        if self.info is not None:
+            self.info.insert(0, ' ')
+        # The genotype columns are one string (see splitLine)
+        if (len(fields) > FIXED_COLUMNS):
+            fields[FIXED_COLUMNS] = fields[FIXED_COLUMNS].replace('\t', '\t ')
+
+    """The annotated line, without line end
+    """
+    def line(self):
+        if self.info is not None:
+            self.fields[7] = ''.join(self.info)
+        return '\t'.join([str(x) for x in self.fields])
+
+
+"""Header lines are passed through untouched by every stage
+"""
+def isHeader(line):
+    return (line.startswith('#') or line.startswith('CHROM'))
 
 
-"""Get information about location in gene structures
+"""For every stage, the position of the last earlier stage writing one of
+   its inputs, or -1 when it only reads the original VCF columns
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
+def stageDependencies(stages):
+    deps = []
+    for i, stage in enumerate(stages):
+        dep = -1
+        for j in range(0, i):
+            if (len(set(stages[j].outputs) & set(stage.inputs)) > 0):
+                dep = j
+        deps.append(dep)
+    return deps
+
+
+"""Opens the reference source of every stage, after checking that the
+   connection pool can serve them all at once
+"""
+def openStages(stages):
+    reference.check_sources(stages)
+    for stage in stages:
+        stage.open()
+
+
+"""Runs each stage over a chunk of Variants
+   Results are always applied in stage order, so the INFO fragments keep
+   their order. With a pool, the lookups of all stages whose inputs are
+   ready run concurrently; a stage reading what an earlier stage writes is
+   only submitted once that stage has been applied to the chunk
+   Returns the lookup results of every stage, in stage order
+"""
+def lookupAndApply(stages, chunk, pool=None):
+    lookups = []
+    if pool is None:
+        for stage in stages:
+            results = stage.lookup_chunk(chunk)
+            for variant, result in zip(chunk, results):
+                stage.apply(variant, result)
+            lookups.append(results)
+        return lookups
+
+    deps = stageDependencies(stages)
+    futures = {}
+    for i, stage in enumerate(stages):
+        if (deps[i] == -1):
+            futures[i] = pool.submit(stage.lookup_chunk, chunk)
+
+    for i, stage in enumerate(stages):
+        if i not in futures:
+            futures[i] = pool.submit(stage.lookup_chunk, chunk)
+        results = futures.pop(i).result()
+        for variant, result in zip(chunk, results):
+            stage.apply(variant, result)
+        lookups.append(results)
+
+        for k in range(i + 1, len(stages)):
+            if (deps[k] == i):
+                futures[k] = pool.submit(stages[k].lookup_chunk, chunk)
+
+    return lookups
+
+
+"""Looks up and applies a chunk of Variants
+   With a cache (see variant_cache.py), variants annotated by an earlier
+   job get the lookup results stored then; only the others are looked up.
+   Results are applied either way, so INFO and counters are the same
+   Returns the lookup results of every stage, by line
+"""
+def lookupCachedAndApply(stages, chunk, pool=None, cache=None):
+    if cache is None:
+        lookups = lookupAndApply(stages, chunk, pool=pool)
+        return [list(results) for results in zip(*lookups)]
+
+    keys = [cache.key(variant) for variant in chunk]
+    cached = cache.get_many(keys)
+
+    misses = [i for i, key in enumerate(keys) if key not in cached]
+    if (len(misses) > 0):
+        lookups = lookupAndApply(stages, [chunk[i] for i in misses],
+            pool=pool)
+        looked_up = [(keys[i], [results[j] for results in lookups])
+            for j, i in enumerate(misses)]
+        cache.put_many(looked_up)
+        cached.update(looked_up)
+        applied = set(misses)
+    else:
+        applied = set()
+
+    for i, (variant, key) in enumerate(zip(chunk, keys)):
+        if i not in applied:
+            for stage, result in zip(stages, cached[key]):
+                stage.apply(variant, result)
+    return [cached[key] for key in keys]
+
+
+"""Annotates a chunk of Variants
+   With a memo, only the first line of each variant not seen earlier in the
+   job is looked up (and checked against the cache); lines repeating a
+   variant get the results of that line
+"""
+def annotateChunk(stages, chunk, pool=None, cache=None, memo=None):
+    if memo is None:
+        lookupCachedAndApply(stages, chunk, pool=pool, cache=cache)
+        return
+
+    keys = [memo.key(variant) for variant in chunk]
+    known = memo.get_many(keys)
+
+    first = {}
+    for i, key in enumerate(keys):
+        if (key not in known and key not in first):
+            first[key] = i
+    if (len(first) > 0):
+        lookups = lookupCachedAndApply(stages,
+            [chunk[i] for i in first.values()], pool=pool, cache=cache)
+        looked_up = list(zip(first.keys(), lookups))
+        memo.put_many(looked_up)
+        known.update(looked_up)
+
+    applied = set(first.values())
+    for i, (variant, key) in enumerate(zip(chunk, keys)):
+        if i not in applied:
+            for stage, result in zip(stages, known[key]):
+                stage.apply(variant, result)
+
+
+"""Streams vcf through stages: every line is parsed once, annotated by all
+   stages in memory and written once to outfile. Data lines are processed
+   chunk_size at a time so stages can batch their lookups; with workers > 1
+   the lookups of independent stages run on that many threads; with a
+   memo, variants repeated in the job are only looked up once
+   .gz inputs are decompressed as they are read, .gz outputs written in
+   BGZF (see bgzf.py)
+   With a checkpoint (see checkpoint.py), the pass records its progress
+   as chunks are flushed and picks up an interrupted pass where it stopped
+"""
+def runStages(vcf, outfile, stages, logfile, logmode='a', chunk_size=2000,
+    sep='\t', format='vcf', workers=0, cache=None, memo=None,
+    checkpoint=None):
 
     inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
 
+    resume = None
+    if checkpoint is not None:
+        resume = checkpoint.load(outfile)
+
+    fh = bgzf.open_input(vcf)
+    if resume is not None:
+        print(f"Resuming from checkpoint at input offset {resume['input_offset']}")
+        fh.seek(resume['input_offset'])
+        fh_out = bgzf.open_output(outfile, offset=resume['output_offset'])
+        for stage, counts in zip(stages, resume['counts']):
+            stage.counts.update(counts)
+        if (cache is not None and resume['cache'] is not None):
+            cache.hits, cache.misses = resume['cache']
+        if (memo is not None and resume['memo'] is not None):
+            memo.lines, memo.lookups = resume['memo']
+    else:
+        fh_out = bgzf.open_output(outfile)
+    openStages(stages)
+
+    pool = None
+    if (workers > 1 and len(stages) > 1):
+        pool = ThreadPoolExecutor(max_workers=workers)
+
+    # The input offset is only a valid restart point once every line read
+    # so far is written, which is not yet the case for a header line
+    def flush(chunk, restartable=True):
+        annotateChunk(stages, chunk, pool=pool, cache=cache, memo=memo)
+        for variant in chunk:
+            fh_out.write(variant.line() + '\n')
+        if (checkpoint is not None and restartable):
+            checkpoint.chunk_done(fh.tell(), fh_out, stages, cache=cache,
+                memo=memo)
+
+    try:
+        chunk = []
+        # readline rather than iteration keeps fh.tell() usable
+        for line in iter(fh.readline, ''):
+            line = line.strip()
+            if (len(line) == 0):
+                continue
+
+            if isHeader(line):
+                if (len(chunk) > 0):
+                    flush(chunk, restartable=False)
+                    chunk = []
+                fh_out.write(line + '\n')
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
-
-            linenum = linenum + 1
+                chunk.append(Variant(splitLine(line, sep=sep), inds))
+                if (len(chunk) >= chunk_size):
+                    flush(chunk)
+                    chunk = []
+
+        if (len(chunk) > 0):
+            flush(chunk)
+
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        for stage in stages:
+            stage.close()
+        fh.close()
+        fh_out.close()
+
+    fh_log = open(logfile, logmode)
+    for stage in stages:
+        stage.write_log(fh_log)
+    if memo is not None:
+        memo.write_log(fh_log)
+    if cache is not None:
+        cache.write_log(fh_log)
+    reference.write_unsorted_log(fh_log,
+        set().union(*[stage.unsorted for stage in stages]))
+    fh_log.close()
+    if checkpoint is not None:
+        checkpoint.remove()
 
-        else:
-            fh_out.write(line + '\n')
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+    Variants are looked up batch_size lines at a time
+"""
+class DbSnpStage(Stage):
+    name = 'dbSNP'
+    inputs = ('CHROM', 'POS', 'REF')
+    outputs = ('ID', 'INFO.DB', 'INFO.VC', 'INFO.GMAF')
+
+    def __init__(self, format='vcf', varclass='SNV', batch_size=2000,
+        bloom_filter=None):
+        Stage.__init__(self, format=format)
+        self.varclass = varclass
+        self.batch_size = max(1, int(batch_size))
+        self.bloom_path = bloom_filter
+        self.bloom = None
+
+    """With a dbSNP Bloom filter (see bloom.py), variants it rules out are
+       never looked up
+    """
+    def open(self):
+        Stage.open(self)
+        if self.bloom_path:
+            import bloom
+            self.bloom = bloom.open_dbsnp_filter(self.bloom_path)
+            self.bloom_key = bloom.dbsnp_key
+
+    def signature(self):
+        return Stage.signature(self) + ':' + self.varclass
+
+    def lookup_chunk(self, chunk):
+        variants = [(variant.chrom, variant.pos, variant.ref,
+            variant.comp_ref) for variant in chunk]
+
+        # Only variants the filter may hold are looked up
+        wanted = list(range(len(variants)))
+        if self.bloom is not None:
+            wanted = [i for i, (chr, pos, ref, compRef) in enumerate(variants)
+                if (self.bloom_key(chr, pos, ref) in self.bloom or
+                    self.bloom_key(chr, pos, compRef) in self.bloom)]
+            self.counts['lookups_avoided'] += len(variants) - len(wanted)
+
+        results = [[] for v in variants]
+        for i in range(0, len(wanted), self.batch_size):
+            batch = wanted[i:i + self.batch_size]
+            rows = lookupDbSnpBatch(self.ref_source,
+                [variants[j] for j in batch], varclass=self.varclass)
+            for j, r in zip(batch, rows):
+                results[j] = r
+        return results
+
+    def lookup(self, variant):
+        return self.lookup_chunk([variant])[0]
+
+    def apply(self, variant, rows):
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        variant.fields[2] = '.'
+        rsids = []
+        mafs = []
+        if (len(rows) > 0):
+            for row in rows:
+                rsids.append(str(row[3]))
+                if (str(row[7]) != '.'):
+                    mafs.append('GMAF=' + str(row[7]))
+
+            maf_str=''
+            if (len(mafs) > 0):
+                maf_str = ';' + ';'.join([str(x) for x in mafs])
+
+            self.counts['var_count'] += 1
+            if (variant.info_text() == '.'):
+                variant.set_info('DB' + maf_str)
+            else:
+                variant.add_info(';DB;VC=' + self.varclass + maf_str)
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+            variant.fields[2] = str(';'.join(rsids))
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+        self.counts['variants'] += 1
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+    def write_log(self, fh_log):
+        # Total has always been reported as the number of variants plus one
+        linenum = self.counts['variants'] + 1
+        var_count = self.counts['var_count']
+        ratioInDbSnp = (var_count / float(linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
+        if self.bloom_path:
+            fh_log.write(f"dbSNP lookups avoided by filter: " + \
+                f"{str(self.counts['lookups_avoided'])}\n")
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t', batch_size=2000):
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+    runStages(vcf + tmpextin, vcf + tmpextout,
+        [DbSnpStage(format=format, varclass=varclass, batch_size=batch_size)],
+        vcf + '.count.log', logmode='w', chunk_size=batch_size, sep=sep,
+        format=format)
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+"""NOTE: all isoforms are collapsed in one record
+    1. chrom_pos_equal_base
+    2. chrom_pos_equal_nobase
+    3. chrom_pos_unequal
+"""
+class BigRefGeneStage(Stage):
+    name = 'BigRefGene'
+    inputs = ('CHROM', 'POS', 'REF', 'ALT')
+    outputs = ('INFO.name', 'INFO.name2', 'INFO.transcriptStrand',
+        'INFO.positionType', 'INFO.functionalClass')
+
+    def open(self):
+        Stage.open(self)
+        self.hapref_ind = self.ref_source.column_index('chrom_pos_equal_base',
+            'haplotypeReference')
+        self.hapalt_ind = self.ref_source.column_index('chrom_pos_equal_base',
+            'haplotypeAlternate')
+
+    def lookup(self, variant):
+        chr = variant.chrom
+        pos = variant.pos
+        # Matched case-insensitively, as MySQL compared them
+        haplotypes = [(str(variant.ref).upper(), str(variant.alt).upper()),
+            (str(variant.comp_ref).upper(), str(variant.comp_alt).upper())]
+
+        rows = [row for row in
+            self.ref_source.lookup('chrom_pos_equal_base', chr, pos)
+            if (str(row[self.hapref_ind]).upper(),
+                str(row[self.hapalt_ind]).upper()) in haplotypes]
+
+        if (len(rows) == 0):
+            rows = self.ref_source.lookup('chrom_pos_equal_nobase', chr, pos)
+
+        if (len(rows) == 0):
+            rows = self.ref_source.lookup('chrom_pos_unequal', chr, pos)
+
+        if (len(rows) == 0):
+            return None
+
+        m = set([])
+        for row in rows:
+            m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+        return m
+
+    def apply(self, variant, m):
+        if m is None:
+            return
+
+        info = variant.info_text() + ';' + ';'.join(m)
+        if info.startswith(".;"):
+            info = info.replace('.;', '', 1)
+        variant.set_info(info)
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
+    runStages(vcf + tmpextin, vcf + tmpextout, [BigRefGeneStage(format=format)],
+        vcf + '.count.log', sep=sep, format=format)
 
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""Counters for the positionType written by BigRefGeneStage
 """
-def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+positionTypeCounters = {
+    'intron': 'intronic_count',
+    'non_coding_intron': 'non_coding_intronic_count',
+    'CDS': 'cds_count',
+    'non_coding_exon': 'non_coding_exonic_count',
+    'utr5': 'utr5_count',
+    'utr3': 'utr3_count'
+}
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+"""Writes the "Variants located" section of the log
+"""
+def writeLocationLog(fh_log, counts):
+    print("Variants located:")
+    fh_log.write("Variants located:\n")
 
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
+    print(f"In interGenic {str(counts['interGenic_count'])}")
+    fh_log.write(f"In interGenic {str(counts['interGenic_count'])}\n")
 
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-            
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if (len(exons) > 0):
-                            region='positionType=non_coding_exon;' + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = 'positionType=non_coding_intron'
-
-                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
-                        if (len(exons) > 0):
-                            region = 'positionType=CDS;' + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = 'positionType=CDS;' + 'intron'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "+")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "-")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and \
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and \
-                        (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                            "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(
-                            row=row, indices=indicesKnownGenes, 
-                            region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+    print(f"In CDS {str(counts['cds_count'])}")
+    fh_log.write(f"In CDS {str(counts['cds_count'])}\n")
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+    print(f"In \'3 UTR {str(counts['utr3_count'])}")
+    fh_log.write(f"In \'3 UTR {str(counts['utr3_count'])}\n")
 
-            linenum = linenum + 1
+    print(f"In \'5 UTR {str(counts['utr5_count'])}")
+    fh_log.write(f"In \'5 UTR {str(counts['utr5_count'])}\n")
 
-        else:
-            fh_out.write(line + '\n')
+    print(f"In Intronic {str(counts['intronic_count'])}")
+    fh_log.write(f"In Intronic {str(counts['intronic_count'])}\n")
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+    print(f"In Non_coding_intronic {str(counts['non_coding_intronic_count'])}")
+    fh_log.write(f"In Non_coding_intronic {str(counts['non_coding_intronic_count'])}\n")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+    print(f"In Exonic {str(counts['exonic_count'])}")
+    fh_log.write(f"In Exonic {str(counts['exonic_count'])}\n")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+    print(f"In Non_coding_exonic {str(counts['non_coding_exonic_count'])}")
+    fh_log.write(f"In Non_coding_exonic {str(counts['non_coding_exonic_count'])}\n")
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+    print(f"In Putative Promoter Region {str(counts['promoter_count'])}")
+    fh_log.write(f"In Putative Promoter Region {str(counts['promoter_count'])}\n")
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
+"""Location of pos in the refGene transcripts rows, whose promoter extended
+   spans cover it: the number of transcripts, one INFO record per
+   transcript pos falls in and the location counts they add. cpg_at(pos)
+   returns the CpG island covering pos, or None
+"""
+def resolveGeneLocation(rows, pos, cpg_at, promoter_offset=500):
+    if (len(rows) == 0):
+        return None
+
+    info = []
+    counts = Counter()
+    cnt = 1
+    for row in rows:
+        txtStart = int(row[4])
+        txtEnd = int(row[5])
+        cdsStart = int(row[6])
+        cdsEnd = int(row[7])
+        exonCount = int(row[8])
+        exonStarts =str(row[9].decode("utf-8"))
+        exonEnds = str(row[10].decode("utf-8"))
+        strand = str(row[3])
+
+        promoter_plus = txtStart - promoter_offset
+        promoter_minus = txtEnd + promoter_offset
+        region = ""
+        exons = []
+        exonsSt = exonStarts.split(',')
+        exonsEn = exonEnds.split(',')
+
+        if (cdsStart == cdsEnd):
+            for e in range(0, exonCount):
+                if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
+                    exnum = e + 1
+                    if (strand == '-'):
+                        exnum = exonCount - e
+                    exons.append("non_coding_exon=" + "ex" + \
+                        str(exnum) + '/' + str(exonCount))
+            if (len(exons) > 0):
+                region = ";".join(exons)
+        elif (u.isBetween(pos, cdsStart, cdsEnd)):
+            for e in range(0, exonCount):
+                if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
+                    exnum = e + 1
+                    if (strand == '-'):
+                        exnum = exonCount - e
+                    exons.append("exon=" +  "ex" + \
+                        str(exnum) + '/' + str(exonCount))
+                    counts['exonic_count'] += 1
+            if (len(exons) > 0):
+                region = ";".join(exons)
+
+        elif ((u.isBetween(pos, promoter_plus, txtStart) and
+            (strand == "+")) or (u.isBetween(pos, txtEnd, promoter_minus)
+            and (strand == "-"))):
+            cpg = cpg_at(pos)
+            if (cpg is not None):
+                region = 'putativePromoterRegion=' + \
+                    "".join(str(cpg[3]).split())
+                counts['promoter_count'] += 1
+
+        if (region != ''):
+            info.append(collapseGeneNames(row=row,
+                indices=indicesKnownGenes, region=region, cnt=cnt))
+
+        cnt = cnt + 1
+
+    return (len(rows), info, counts)
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+"""Get information about location in gene structures
+"""
+class GenesStage(Stage):
+    name = 'Genes'
+    inputs = ('CHROM', 'POS', 'INFO.positionType')
+    outputs = ('INFO.name', 'INFO.name2', 'INFO.transcriptStrand',
+        'INFO.exon', 'INFO.non_coding_exon', 'INFO.putativePromoterRegion',
+        'INFO.positionType')
+
+    def __init__(self, format='vcf', table='refGene', promoter_offset=500,
+        segment_map=None):
+        Stage.__init__(self, format=format)
+        self.table = table
+        self.promoter_offset = int(promoter_offset)
+        self.segment_map_path = segment_map
+        self.segments = None
+
+    def signature(self):
+        return Stage.signature(self) + f":{self.table}:{self.promoter_offset}"
+
+    """With a segment map (see segment_map.py) built from the reference
+       version in use, locations are read from it instead of the database
+    """
+    def open(self):
+        Stage.open(self)
+        if self.segment_map_path:
+            import segment_map
+            self.segments = segment_map.open_segment_map(self.segment_map_path)
+            if (self.segments is not None and
+                (self.segments.table != self.table or
+                self.segments.promoter_offset != self.promoter_offset)):
+                raise ValueError(f"Segment map {self.segment_map_path} was " + \
+                    f"built for {self.segments.table} with promoter offset " + \
+                    f"{self.segments.promoter_offset}")
+
+    """Returns None for intergenic variants, otherwise the number of
+       transcripts found, their INFO records and the counts they add
+    """
+    def lookup(self, variant):
+        chr = variant.ucsc_chrom
+        pos = variant.pos
+
+        if self.segments is not None:
+            return self.segments.lookup(chr, pos)
+
+        rows = self.ref_source.lookup(self.table, chr, pos,
+            offset=self.promoter_offset)
+        if (len(rows) == 0):
+            return None
+
+        return resolveGeneLocation(rows, pos,
+            lambda p: getCpgIsland(self.ref_source, chr, p),
+            promoter_offset=self.promoter_offset)
+
+    def apply(self, variant, result):
+        if result is None:
+            variant.add_info(";positionType=interGenic")
+            self.counts['interGenic_count'] += 1
+            return
+
+        transcripts, info, counts = result
+        # Every transcript counts the location found by BigRefGeneStage
+        info_field = clean_mysql_chars(variant.info_text()).strip()
+        positionType = str(u.parse_field(info_field, 'positionType', ';', '='))
+        if positionType in positionTypeCounters:
+            self.counts[positionTypeCounters[positionType]] += transcripts
+        self.counts.update(counts)
+
+        variant.add_info(';' + ";".join(info))
+
+    def write_log(self, fh_log):
+        writeLocationLog(fh_log, self.counts)
+
+
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+    runStages(vcf + tmpextin, vcf + tmpextout,
+        [GenesStage(format=format, table=table, promoter_offset=promoter_offset)],
+        vcf + '.count.log', sep=sep, format=format)
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""
+class ExonsEtAlStage(GenesStage):
+    name = 'ExonsEtAl'
+    inputs = ('CHROM', 'POS')
+
+    def lookup(self, variant):
+        chr = variant.ucsc_chrom
+        pos = variant.pos
+
+        rows = self.ref_source.lookup(self.table, chr, pos,
+            offset=self.promoter_offset)
+        if (len(rows) == 0):
+            return None
+
+        info = []
+        counts = Counter()
+        cnt = 1
+        for row in rows:
+            txtStart = int(row[4])
+            txtEnd = int(row[5])
+            cdsStart = int(row[6])
+            cdsEnd = int(row[7])
+            exonCount = int(row[8])
+            exonStarts =str(row[9].decode('utf-8'))
+            exonEnds = str(row[10].decode('utf-8'))
+            strand = str(row[3])
+
+            promoter_plus = txtStart - self.promoter_offset
+            promoter_minus = txtEnd + self.promoter_offset
+            region = ""
+            exons = []
+            exonsSt = exonStarts.split(',')
+            exonsEn = exonEnds.split(',')
+
+            if (cdsStart == cdsEnd):
+                for e in range(0, exonCount):
+                    if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
+                        exnum = e + 1
+                        if (strand == '-'):
+                            exnum =  exonCount - e
+                        exons.append("non_coding_exon=" + "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                        counts['non_coding_exonic_count'] += 1
+                if (len(exons) > 0):
+                    region='positionType=non_coding_exon;' + ";".join(exons)
+                else:
+                    counts['non_coding_intronic_count'] += 1
+                    region = 'positionType=non_coding_intron'
+
+            elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
+                counts['cds_count'] += 1
+                for e in range(0, exonCount):
+                    if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
+                        exnum = e + 1
+                        if (strand == '-'):
+                            exnum =  exonCount - e
+                        exons.append("exon=" + "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                        counts['exonic_count'] += 1
+                if (len(exons) > 0):
+                    region = 'positionType=CDS;' + ";".join(exons)
+                else:
+                    counts['intronic_count'] += 1
+                    region = 'positionType=CDS;' + 'intron'
+
+            elif (u.isBetween(pos, txtStart, cdsStart) and \
+                (cdsStart < cdsEnd) and (strand == "+")):
+                counts['utr5_count'] += 1
+                region = 'positionType=utr5'
+
+            elif (u.isBetween(pos, cdsEnd, txtEnd) and \
+                (cdsStart < cdsEnd) and (strand == "+")):
+                counts['utr3_count'] += 1
+                region = 'positionType=utr3'
+
+            elif (u.isBetween(pos, cdsEnd, txtEnd) and
+                (cdsStart < cdsEnd) and (strand == "-")):
+                counts['utr5_count'] += 1
+                region = 'positionType=utr5'
+
+            elif (u.isBetween(pos, txtStart, cdsStart) and \
+                (cdsStart < cdsEnd) and (strand == "-")):
+                counts['utr3_count'] += 1
+                region = 'positionType=utr3'
+
+            elif ((u.isBetween(pos, promoter_plus, txtStart) and \
+                (strand == "+")) or (u.isBetween(pos, txtEnd, promoter_minus)
+                and (strand == "-"))):
+                cpg = getCpgIsland(self.ref_source, chr, pos)
+                if (cpg is not None):
+                    region = 'putativePromoterRegion=' + \
+                        "".join(str(cpg[3]).split())
+                    counts['promoter_count'] += 1
+
+            if (region != ''):
+                info.append(collapseGeneNames(
+                    row=row, indices=indicesKnownGenes,
+                    region=region, cnt=cnt))
+
+            cnt = cnt + 1
+
+        return (len(rows), info, counts)
+
+    def apply(self, variant, result):
+        if result is None:
+            variant.add_info(";positionType=interGenic")
+            self.counts['interGenic_count'] += 1
+            return
+
+        transcripts, info, counts = result
+        self.counts.update(counts)
+        variant.add_info(';' + ";".join(info))
+
+
+def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
+    tmpextin='.2', tmpextout='.3', sep='\t'):
+
+    runStages(vcf + tmpextin, vcf + tmpextout,
+        [ExonsEtAlStage(format=format, table=table,
+            promoter_offset=promoter_offset)],
+        vcf + '.count.log', sep=sep, format=format)
 
 
 """Overlap with tfbsConsSites
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
+class TfbsConsSitesStage(OverlapStage):
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+    def __init__(self, format='vcf', table='tfbsConsSites'):
+        OverlapStage.__init__(self, table, format=format)
+        self.outputs = ('INFO.tfbsRegion',)
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def lookup(self, variant):
+        # For some reason this table has no "chr" preceeding number
+        chr = variant.ucsc_chrom
+        pos = variant.pos
+        chrIndex = chr.replace('chr', '')
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+        if (chrIndex not in self.allowed_chrom):
+            return []
+        return self.ref_source.lookup('tfbsConsSites' + chrIndex, chr, pos,
+            columns=('chrom', 'chromStart', 'chromEnd', 'name'))
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    def apply(self, variant, rows):
+        if (len(rows) == 0):
+            return
 
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
+        self.counts['line_count'] += 1
+        records = []
+        for row in rows:
+            self.counts['var_count'] += 1
+            t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                str(row[1]) + '.' + str(row[2])
+            t = t.strip()
+            records.append('tfbsRegion' + '=' + t)
 
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
+        variant.append_info(';'.join(records))
 
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-
-                    fh_out.write('\t'.join(fields) + '\n')
-
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
-
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
-
-        linenum = linenum + 1
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStages(vcf + tmpextin, vcf + tmpextout,
+        [TfbsConsSitesStage(format=format, table=table)],
+        vcf + '.count.log', sep=sep, format=format)
 
 
 """Overlap with GadAll table
 """
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
+class GadAllStage(OverlapStage):
+    def __init__(self, format='vcf', table='gadAll'):
+        OverlapStage.__init__(self, table, format=format)
+
+    def lookup(self, variant):
+        # For some reason this table has no "chr" preceeding number
+        chr = variant.chrom
+        pos = variant.pos
+        return self.ref_source.lookup(self.table, chr, pos)
+
+    def apply(self, variant, rows):
+        if (len(rows) == 0):
+            return
+
+        self.counts['line_count'] += 1
+        records = []
+        r_tmp = []
+        for row in rows:
+            self.counts['var_count'] += 1
+            if not fu.isOnTheList(r_tmp, str(row[3])):
+                r_tmp.append(str(row[3]) )
+                records.append(str(self.table) + '=' + str(row[3]))
+
+        variant.append_info(';'.join(records))
+        # Annotated lines have always been written with a space after
+        # every tab; keep the output identical. Lookups of later stages
+        # strip the columns they read, so they do not depend on this
+        variant.space_columns()
+
+
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
     tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    runStages(vcf + tmpextin, vcf + tmpextout,
+        [GadAllStage(format=format, table=table)],
+        vcf + '.count.log', sep=sep, format=format)
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+""" Overlap with gwasCatalog table """
+class GwasCatalogStage(OverlapStage):
+    def __init__(self, format='vcf', table='gwasCatalog'):
+        OverlapStage.__init__(self, table, format=format)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    def lookup(self, variant):
+        chr = variant.ucsc_chrom
+        pos = variant.pos
+        return self.ref_source.lookup(self.table, chr, pos)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    def apply(self, variant, rows):
+        if (len(rows) == 0):
+            return
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        self.counts['line_count'] += 1
+        records = []
+        for row in rows:
+            self.counts['var_count'] += 1
+            records.append(str(self.table) + '=' + str('pubMedID') + \
+                '=' + str(row[5]) + ',trait=' + str(row[10]))
+
+        variant.append_info(';'.join(records))
 
 
-""" Overlap with gwasCatalog table """
 def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStages(vcf + tmpextin, vcf + tmpextout,
+        [GwasCatalogStage(format=format, table=table)],
+        vcf + '.count.log', sep=sep, format=format)
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
+class HugoStage(OverlapStage):
+    def __init__(self, format='vcf', table='hugo'):
+        OverlapStage.__init__(self, table, format=format)
+        self.outputs = ('INFO.HGNC_GeneAnnotation',)
+
+    def lookup(self, variant):
+        chr = variant.ucsc_chrom
+        pos = variant.pos
+        return self.ref_source.lookup(self.table, chr, pos)
+
+    def apply(self, variant, rows):
+        if (len(rows) == 0):
+            return
+
+        self.counts['line_count'] += 1
+        records = []
+        r_tmp = []
+        for row in rows:
+            self.counts['var_count'] += 1
+            t = str(str(row[5]) + ',' + str(row[6])).strip()
+            if not fu.isOnTheList(r_tmp, t):
+                r_tmp.append(t)
+                records.append('HGNC_GeneAnnotation' + '=' + t)
+
+        variant.append_info(','.join(records).replace(';', ','))
+
+
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStages(vcf + tmpextin, vcf + tmpextout,
+        [HugoStage(format=format, table=table)],
+        vcf + '.count.log', sep=sep, format=format)
 
 
 """Overlap with segdup regions genomicSuperDups
 """
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
+class GenomicSuperDupsStage(OverlapStage):
+    def __init__(self, format='vcf', table='genomicSuperDups'):
+        OverlapStage.__init__(self, table, format=format)
+        self.outputs = ('INFO.' + table, 'INFO.otherChrom', 'INFO.otherStart',
+            'INFO.otherEnd')
+
+    def lookup(self, variant):
+        chr = variant.ucsc_chrom
+        pos = variant.pos
+        return getFirst(self.ref_source.lookup(self.table, chr, pos, limit=1))
+
+    def apply(self, variant, row):
+        if row is None:
+            return
+
+        self.counts['line_count'] += 1
+        self.counts['var_count'] += 1
+        isOverlap = True
+        otherChrom = row[7]
+        otherStart = row[8]
+        otherEnd = row[9]
+        variant.add_info(';' + str(self.table) + '=' + \
+            str(isOverlap) + ';' + 'otherChrom=' + \
+            str(otherChrom) + ';otherStart=' + \
+            str(otherStart) + ';otherEnd=' + str(otherEnd))
+
+
+def addOverlapWithGenomicSuperDups(vcf, format='vcf',
     table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    runStages(vcf + tmpextin, vcf + tmpextout,
+        [GenomicSuperDupsStage(format=format, table=table)],
+        vcf + '.count.log', sep=sep, format=format)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+"""Searches Genes Databases and returns Genes/Cytobands
+   with which SNP or INDEL overlaps
+"""
+class RefGeneStage(OverlapStage):
+    def __init__(self, format='vcf', table='refGene'):
+        OverlapStage.__init__(self, table, format=format)
+        self.outputs = ('INFO.name2', 'INFO.name')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    def lookup(self, variant):
+        chr = variant.ucsc_chrom
+        pos = variant.pos
+        return self.ref_source.lookup(self.table, chr, pos)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    def apply(self, variant, rows):
+        if (len(rows) == 0):
+            return
 
+        self.counts['line_count'] += 1
+        overlapsWith = []
+        for row in rows:
+            self.counts['var_count'] += 1
+            overlapsWith.append('name2' + '=' + str(row[12]) + ';' + \
+                'name' + '=' + str(row[1]))
 
-"""Searches Genes Databases and returns Genes/Cytobands 
-   with which SNP or INDEL overlaps
-"""
-def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 1
-    colindex2 = 12
-    name = 'name'
-    name2 = 'name2'
-    startName = 'txStart'
-    endName = 'txEnd'
+        variant.append_info(';'.join([str(x) for x in overlapsWith]))
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
-
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
+    tmpextin='', tmpextout='.1', sep='\t'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStages(vcf + tmpextin, vcf + tmpextout,
+        [RefGeneStage(format=format, table=table)],
+        vcf + '.count.log', sep=sep, format=format)
 
 
 """Method to find overlap with Cytoband table
 """
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
+class CytobandStage(OverlapStage):
+    def __init__(self, format='vcf', table='cytoBand'):
+        OverlapStage.__init__(self, table, format=format)
+        self.colindex = 12
+        if (table == 'cytoBand'):
+            self.colindex = 3
+
+    def lookup(self, variant):
+        chr = variant.ucsc_chrom
+        pos = variant.pos
+        return self.ref_source.lookup(self.table, chr, pos)
+
+    def apply(self, variant, rows):
+        if (len(rows) == 0):
+            return
+
+        self.counts['line_count'] += 1
+        overlapsWith = []
+        for row in rows:
+            self.counts['var_count'] += 1
+            overlapsWith.append(str(row[self.colindex]))
+        overlapsWith = u.dedup(overlapsWith)
+        cytoband = ';'.join([str(x) for x in overlapsWith])
+
+        variant.append_info(str(self.table) + '=' + str(cytoband))
+
+
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
-
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStages(vcf + tmpextin, vcf + tmpextout,
+        [CytobandStage(format=format, table=table)],
+        vcf + '.count.log', sep=sep, format=format)
 
 
 """Method to find overlap with CNV tables
 """
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class CnvStage(OverlapStage):
+    def __init__(self, format='vcf', table='dgv_Cnv'):
+        OverlapStage.__init__(self, table, format=format)
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def lookup(self, variant):
+        chr = variant.ucsc_chrom
+        pos = variant.pos
+        return getFirst(self.ref_source.lookup(self.table, chr, pos, limit=1))
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def apply(self, variant, row):
+        if row is None:
+            return
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        self.counts['line_count'] += 1
+        self.counts['var_count'] += 1
+        isOverlap = True
+        variant.append_info(str(self.table) + '=' + str(isOverlap))
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
+    tmpextin='', tmpextout='.1', sep='\t'):
+
+    runStages(vcf + tmpextin, vcf + tmpextout,
+        [CnvStage(format=format, table=table)],
+        vcf + '.count.log', sep=sep, format=format)
 
 
 """Method to find overlap with targetScanS tables
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class MiRNAStage(OverlapStage):
+    def __init__(self, format='vcf', table='targetScanS'):
+        OverlapStage.__init__(self, table, format=format)
+        self.name = 'miRNAsites'
+        self.outputs = ('INFO.miRNAsites',)
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def lookup(self, variant):
+        chr = variant.ucsc_chrom
+        pos = variant.pos
+        return getFirst(self.ref_source.lookup(self.table, chr, pos, limit=1))
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def apply(self, variant, row):
+        if row is None:
+            return
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        self.counts['line_count'] += 1
+        self.counts['var_count'] += 1
+        t = str(row[4]) + ',' +  str(row[1]) + '_' + \
+            str(row[2]) + '_' + str(row[3])
+        variant.append_info('miRNAsites=' + t.strip())
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
+    tmpextin='', tmpextout='.1', sep='\t'):
+
+    runStages(vcf + tmpextin, vcf + tmpextout,
+        [MiRNAStage(format=format, table=table)],
+        vcf + '.count.log', sep=sep, format=format)
 
-### EOF
\ No newline at end of file
+### EOF
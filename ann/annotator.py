@@ -1,11 +1,20 @@
-import subprocess
 import os
 import json
+import time
 import boto3
+import shutil
+import socket
 import botocore
+import threading
+import multiprocessing
+from collections import deque
 from configparser import ConfigParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import ast
 
+import run
+
 jobs_dir = './jobs'
 
 if not os.path.exists(jobs_dir):
@@ -17,14 +26,495 @@ if not os.path.exists(jobs_dir):
 # source: https://stackoverflow.com/questions/18973418/os-mkdirpath-returns-oserror-when-directory-does-not-exist
 
 CONFIG_FILE = '/home/ec2-user/mpcs-cc/gas/ann/ann_config.ini'
+
+# Most messages SQS returns per receive_message or takes per
+# delete_message_batch
+SQS_BATCH_SIZE = 10
+
+
+# Jobs run in long-lived worker processes that imported run.py, driver
+# and annotate once and keep their AWS clients and reference database
+# connections from job to job. Workers are forked from a fork server that
+# preloaded run.py rather than from this process, whose download threads
+# may hold locks (in boto3, urllib3, ...) at the time of the fork
+def start_pool(workers):
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['run'])
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context,
+        initializer=run.warm_up)
+
+
+# Moves jobs from the queue to the worker pool
+#
+# Messages are taken off the queue only while the scheduler has room for
+# them: one slot per worker plus `prefetch` jobs whose inputs are
+# downloaded ahead, on `download_threads` threads, while the workers are
+# busy. Each job is claimed in DynamoDB before its input is downloaded
+# (see claim_job), so a duplicate message costs one conditional update. A
+# job starts as soon as its input is downloaded and a worker is free, in
+# the order the messages arrived.
+#
+# Until a job is done with, a heartbeat keeps its message invisible to
+# other instances and renews its lease. Its message is acknowledged only
+# once run_job has uploaded the results and marked the job COMPLETED (or
+# the job is found already complete); after a failure, the lease is
+# released and the message comes back for a retry, up to max_attempts
+# deliveries, after which the job is marked FAILED
+class JobScheduler(object):
+    def __init__(self, sqs, table_name, workers, prefetch=0, download_threads=4,
+        lease_seconds=300, heartbeat_seconds=60, visibility_timeout=300,
+        max_attempts=5):
+        self.sqs = sqs
+        self.table_name = table_name
+        self.lease_owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.lease_seconds = lease_seconds
+        self.local = threading.local()
+        self.s3_client = boto3.client('s3', region_name='us-east-1')
+        self.workers = workers
+        self.capacity = workers + max(0, prefetch)
+        self.pool = start_pool(workers)
+        self.downloads = ThreadPoolExecutor(max_workers=download_threads)
+        self.cond = threading.Condition()
+        self.fetching = deque()  # jobs in arrival order, until they start
+        self.running = {}  # running jobs by future
+        self.acks = []  # jobs whose messages are to be deleted
+        self.heartbeat_seconds = heartbeat_seconds
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+
+    # boto3 resources may not be shared between threads, so every thread
+    # gets its own table from its own session
+    def table(self):
+        if not hasattr(self.local, 'ann_table'):
+            dynamodb = boto3.session.Session().resource('dynamodb', region_name='us-east-1')
+            self.local.ann_table = dynamodb.Table(self.table_name)
+        return self.local.ann_table
+
+    def free_slots(self):
+        with self.cond:
+            return self.capacity - len(self.fetching) - len(self.running)
+
+    # Waits up to timeout seconds for a free slot; returns whether there is one
+    def wait_for_slot(self, timeout=None):
+        with self.cond:
+            if (self.capacity - len(self.fetching) - len(self.running) <= 0):
+                self.cond.wait(timeout)
+            return self.capacity - len(self.fetching) - len(self.running) > 0
+
+    # Jobs whose messages are to be acknowledged since the last call
+    def take_acks(self):
+        with self.cond:
+            acks = self.acks
+            self.acks = []
+            return acks
+
+    def add(self, job):
+        with self.cond:
+            job['downloaded'] = False
+            self.fetching.append(job)
+        self.downloads.submit(self._download, job)
+
+    def _download(self, job):
+        try:
+            self._fetch(job)
+        except Exception as e:
+            # Whatever else goes wrong (a connection error, a malformed item,
+            # ...) must not leave the job at the head of the line, where it
+            # would hold back every later job and keep its message invisible
+            print({'code': 500, 'status': 'error', 'message': f"Cannot fetch job {job['job_id']}: {str(e)}"})
+            ack = False
+            if job.get('claimed'):
+                ack = self._retry(job)
+            self._drop(job, ack=ack)
+
+    # Claims a job and downloads its input
+    def _fetch(self, job):
+        try:
+            claimed = claim_job(self.table(), job['job_id'], self.lease_owner,
+                self.lease_seconds)
+            if not claimed:
+                response = self.table().get_item(Key={'job_id': job['job_id']})
+                status = response['Item']['job_status']
+        except (botocore.exceptions.ClientError, KeyError) as e:
+            # The message is not acknowledged and comes back once its
+            # visibility timeout expires
+            print({'code': 500, 'status': 'error', 'message': f"Cannot claim job {job['job_id']}: {str(e)}"})
+            self._drop(job)
+            return
+
+        job['claimed'] = True
+        if not claimed:
+            job['claimed'] = False
+            # handle if the job is already complete, or was given up on
+            if status in ('COMPLETED', 'FAILED'):
+                print(f"Job is already {status.lower()}!")
+                self._drop(job, ack=True)
+            else:
+                # Another worker holds the lease; the message comes back
+                # after its visibility timeout, when the job is either
+                # complete or, if that worker died, up for reclaiming
+                print(f"Job {job['job_id']} is claimed by another worker")
+                self._drop(job)
+            return
+
+        # Download the file from S3
+        if not download_file_from_s3(job['bucket_name'], job['key'],
+            job['file_path'], s3_client=self.s3_client):
+            self._drop(job, ack=self._retry(job))
+            return
+        print('File processed successfully with path', job['file_path'])
+
+        with self.cond:
+            job['downloaded'] = True
+        self._start_ready()
+
+    # Gives up on a job that has not started, acknowledging its message
+    # with ack
+    def _drop(self, job, ack=False):
+        with self.cond:
+            if job not in self.fetching:
+                return
+            self.fetching.remove(job)
+            if ack:
+                self.acks.append(job)
+            self.cond.notify_all()
+        self._start_ready()
+
+    def _finished(self, future):
+        with self.cond:
+            job = self.running[future]
+        completed = (future.exception() is None and future.result())
+        if future.exception() is not None:
+            print({'code': 500, 'status': 'error', 'message': f"Annotation job {job['job_id']} failed: {str(future.exception())}"})
+        elif not completed:
+            print({'code': 500, 'status': 'error', 'message': f"Annotation job {job['job_id']} did not complete"})
+        ack = completed
+        if not completed:
+            ack = self._retry(job)
+
+        with self.cond:
+            del self.running[future]
+            if ack:
+                self.acks.append(job)
+            self.cond.notify_all()
+        self._start_ready()
+
+    # Lets the next delivery of a failed job's message retry it or, once
+    # the message has been delivered max_attempts times, marks the job
+    # FAILED. Returns whether the message is to be acknowledged
+    def _retry(self, job):
+        if (job['receive_count'] < self.max_attempts):
+            self._release(job)
+            return False
+        print(f"Giving up on job {job['job_id']} after {job['receive_count']} attempts")
+        try:
+            fail_job(self.table(), job['job_id'], self.lease_owner)
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            print(f"Error marking job {job['job_id']} failed: {str(e)}")
+            self._release(job)
+            return False
+        # Results kept for a retry that will not come
+        shutil.rmtree(job['dir_path'], ignore_errors=True)
+        return True
+
+    # Lets the next delivery of a failed job's message reclaim it
+    def _release(self, job):
+        try:
+            set_lease_expiry(self.table(), job['job_id'], self.lease_owner, 0)
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            print(f"Error releasing job {job['job_id']}: {str(e)}")
+
+    # Every heartbeat_seconds, extends the visibility timeout of the
+    # messages of all jobs in flight and the leases of the claimed ones.
+    # Errors (including connection errors and timeouts, which are not
+    # ClientErrors) are logged and retried on the next beat: the thread
+    # must outlive them, or long jobs would be redelivered and reclaimed
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.heartbeat_seconds)
+            try:
+                self._beat()
+            except Exception as e:
+                print(f"Error in the heartbeat: {str(e)}")
+
+    def _beat(self):
+        with self.cond:
+            jobs = list(self.fetching) + list(self.running.values())
+        try:
+            extend_visibility(self.sqs, jobs, self.visibility_timeout)
+        except Exception as e:
+            print(f"Error extending message visibility: {str(e)}")
+        for job in jobs:
+            if job.get('claimed'):
+                try:
+                    if not set_lease_expiry(self.table(), job['job_id'],
+                        self.lease_owner, int(time.time()) + self.lease_seconds):
+                        print(f"Lost the lease on job {job['job_id']}")
+                except Exception as e:
+                    print(f"Error extending the lease on job {job['job_id']}: {str(e)}")
+
+    # Hands the downloaded jobs at the head of the line to free workers
+    def _start_ready(self):
+        started = []
+        failed = []
+        with self.cond:
+            while (len(self.fetching) > 0 and self.fetching[0]['downloaded'] and
+                len(self.running) < self.workers):
+                job = self.fetching.popleft()
+                future = self._submit(job)
+                if future is not None:
+                    self.running[future] = job
+                    tier = job['tier']
+                    waited = time.time() - job['sent_time']
+                    tier.record_wait(waited)
+                    started.append((job, future, waited, tier.wait_summary()))
+                else:
+                    failed.append(job)
+            self.cond.notify_all()
+
+        for job in failed:
+            self._release(job)
+
+        for (job, future, waited, summary) in started:
+            future.add_done_callback(self._finished)
+            print(f"{job['tier'].name} job {job['job_id']} waited {waited:.1f} s in the queue ({summary})")
+            response = {
+                "code": 201,
+                "data": {
+                    "job_id": job['job_id'],
+                    "input_file": job['filename']
+                },
+                "status": "Success"
+            }
+            print(response)
+
+    def _submit(self, job):
+        args = (job['file_path'], job['dir_path'], job['user_id'], job['job_id'], job['user_email'],
+                self.lease_owner)
+        try:
+            try:
+                return self.pool.submit(run.run_job, *args)
+            except BrokenProcessPool:
+                # A worker died (e.g. out of memory), which takes the pool
+                # down with it; the jobs it ran are reported as failed
+                self.pool = start_pool(self.workers)
+                return self.pool.submit(run.run_job, *args)
+        except RuntimeError as e:
+            print({'code': 500, 'status': 'error', 'message': f'Failed to launch annotation job: {str(e)}'})
+            return None
+
+
+# A request queue and the share of the workers its jobs get, with the
+# time its jobs waited in the queue before they started
+class QueueTier(object):
+    def __init__(self, name, queue_url, weight=1):
+        self.name = name
+        self.queue_url = queue_url
+        self.weight = max(1, weight)
+        self.started = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_wait(self, seconds):
+        self.started = self.started + 1
+        self.total_wait = self.total_wait + seconds
+        self.max_wait = max(self.max_wait, seconds)
+
+    def wait_summary(self):
+        mean = self.total_wait / self.started if self.started > 0 else 0.0
+        return f"{self.name}: {self.started} jobs, mean {mean:.1f} s, max {self.max_wait:.1f} s"
+
+
+# Weighted fair order in which the queues of several tiers are read
+#
+# Stride scheduling: every message taken from a tier advances its pass by
+# 1/weight, and the tier whose pass would be lowest after its next message
+# is read first, so with
+# weights 4 and 1 four premium jobs are taken per free job while both
+# queues have a backlog. A tier found empty is brought up to the others'
+# pass, so that it does not bank credit while idle and then crowd them
+# out. As protection against starvation, a tier that has not been read for
+# starvation_seconds (e.g. while long jobs keep every worker busy and each
+# free slot goes to the premium queue) is read first
+class TierPicker(object):
+    def __init__(self, tiers, starvation_seconds=600):
+        self.tiers = tiers
+        self.starvation_seconds = starvation_seconds
+        now = time.time()
+        self.passes = dict((tier.name, 0.0) for tier in tiers)
+        self.read_at = dict((tier.name, now) for tier in tiers)
+
+    # Tiers in the order their queues are to be read
+    def order(self):
+        now = time.time()
+        starved = [tier for tier in self.tiers
+            if now - self.read_at[tier.name] >= self.starvation_seconds]
+        starved.sort(key=lambda tier: self.read_at[tier.name])
+        rest = [tier for tier in self.tiers if tier not in starved]
+        rest.sort(key=lambda tier: self.passes[tier.name] + 1.0 / tier.weight)
+        return starved + rest
+
+    # Records that received messages were taken from the queue of tier
+    def read(self, tier, received):
+        self.read_at[tier.name] = time.time()
+        if (received > 0):
+            self.passes[tier.name] = self.passes[tier.name] + received / float(tier.weight)
+        elif (len(self.tiers) > 1):
+            others = min(self.passes[other.name] for other in self.tiers if other is not tier)
+            self.passes[tier.name] = max(self.passes[tier.name], others)
+
+
+# Claims a job for owner until lease_seconds from now: moves it from
+# PENDING to RUNNING, or takes over a RUNNING job whose lease has expired
+# (its worker died) or that has no lease (it was started by an annotator
+# from before leases). Returns False when the job is complete or another
+# worker holds a live lease on it
+# https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.ConditionExpressions.html
+def claim_job(ann_table, job_id, owner, lease_seconds):
+    now = int(time.time())
+    try:
+        ann_table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET job_status = :new_status, lease_owner = :owner, lease_expiry = :expiry',
+            ConditionExpression='job_status = :pending OR (job_status = :new_status AND lease_expiry < :now) '
+                'OR (job_status = :new_status AND attribute_not_exists(lease_expiry))',
+            ExpressionAttributeValues={
+                ':new_status': 'RUNNING',
+                ':pending': 'PENDING',
+                ':owner': owner,
+                ':expiry': now + lease_seconds,
+                ':now': now
+            }
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+
+# Moves the end of the lease of owner on a job to expiry: later to extend
+# it, 0 to end it so that a failed job can be reclaimed right away.
+# Returns False when the job is no longer claimed by owner
+def set_lease_expiry(ann_table, job_id, owner, expiry):
+    try:
+        ann_table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET lease_expiry = :expiry',
+            ConditionExpression='job_status = :running AND lease_owner = :owner',
+            ExpressionAttributeValues={
+                ':running': 'RUNNING',
+                ':owner': owner,
+                ':expiry': expiry
+            }
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+
+# Marks a job claimed by owner FAILED, ending the claim. Returns False
+# when the job is no longer claimed by owner
+def fail_job(ann_table, job_id, owner):
+    try:
+        ann_table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET job_status = :failed REMOVE lease_owner, lease_expiry',
+            ConditionExpression='job_status = :running AND lease_owner = :owner',
+            ExpressionAttributeValues={
+                ':failed': 'FAILED',
+                ':running': 'RUNNING',
+                ':owner': owner
+            }
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+
+# Job described by an SQS message received from the queue of tier
+def parse_job(sqs_message, tier):
+    message_json = json.loads(sqs_message["Body"])
+    message = ast.literal_eval(message_json["Message"])
+
+    user_id = message['user_id']
+    uuid = message['job_id']
+    filename = message['input_file_name']
+
+    # Save the file in a unique path
+    dir_path = os.path.join(jobs_dir, user_id, uuid)
+    os.makedirs(dir_path, exist_ok=True)
+
+    return {
+        'queue_url': tier.queue_url,
+        'tier': tier,
+        'sent_time': int(sqs_message.get('Attributes', {}).get('SentTimestamp', time.time() * 1000)) / 1000.0,
+        'receipt_handle': sqs_message["ReceiptHandle"],
+        'receive_count': int(sqs_message.get('Attributes', {}).get('ApproximateReceiveCount', 1)),
+        'key': message['s3_key_input_file'],
+        'user_id': user_id,
+        'job_id': uuid,
+        'filename': filename,
+        'user_email': message['user_email'],
+        'bucket_name': message['s3_inputs_bucket'],
+        'dir_path': dir_path,
+        'file_path': os.path.join(dir_path, filename)
+    }
+
+
+# Messages of jobs in batches of at most SQS_BATCH_SIZE from one queue,
+# as (queue url, batch entries)
+def message_batches(jobs, **fields):
+    by_queue = {}
+    for job in jobs:
+        by_queue.setdefault(job['queue_url'], []).append(job)
+    for queue_url, queue_jobs in by_queue.items():
+        for i in range(0, len(queue_jobs), SQS_BATCH_SIZE):
+            yield (queue_url, [dict({'Id': str(n), 'ReceiptHandle': job['receipt_handle']}, **fields)
+                for n, job in enumerate(queue_jobs[i:i + SQS_BATCH_SIZE])])
+
+
+# https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_DeleteMessageBatch.html
+def delete_messages(sqs, jobs):
+    for (queue_url, entries) in message_batches(jobs):
+        response = sqs.delete_message_batch(QueueUrl=queue_url, Entries=entries)
+        for failure in response.get('Failed', []):
+            print(f"Error deleting message: {failure.get('Message', failure.get('Code'))}")
+        print(f"{len(response.get('Successful', []))} messages deleted")
+
+
+# https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/sqs-visibility-timeout.html
+def extend_visibility(sqs, jobs, visibility_timeout):
+    for (queue_url, entries) in message_batches(jobs, VisibilityTimeout=visibility_timeout):
+        response = sqs.change_message_visibility_batch(QueueUrl=queue_url, Entries=entries)
+        for failure in response.get('Failed', []):
+            print(f"Error extending message visibility: {failure.get('Message', failure.get('Code'))}")
+
+
 def process_annotations():
     config = ConfigParser()
     config.read_file(open(CONFIG_FILE))
 
+    workers = config.getint('ANNOTATOR', 'Workers', fallback=0) or os.cpu_count() or 1
+
     try:
         sqs = boto3.client('sqs', region_name='us-east-1')
+        tiers = []
+        # Premium jobs come on a queue of their own when one is configured
+        premium_queue_name = config.get('AWS', 'SQSPremiumRequestsQueueName', fallback='')
+        if premium_queue_name:
+            tiers.append(QueueTier('premium',
+                sqs.get_queue_url(QueueName=premium_queue_name)['QueueUrl'],
+                weight=config.getint('ANNOTATOR', 'PremiumWeight', fallback=4)))
         queue_name = config.get('AWS', 'SQSRequestsQueueName')
-        queue_url = sqs.get_queue_url(QueueName=queue_name)['QueueUrl']
+        tiers.append(QueueTier('free' if tiers else 'all',
+            sqs.get_queue_url(QueueName=queue_name)['QueueUrl'],
+            weight=config.getint('ANNOTATOR', 'FreeWeight', fallback=1)))
 
     except botocore.exceptions.ClientError as e:  # Queue Not Found
         print({
@@ -33,93 +523,65 @@ def process_annotations():
             'message': f'Queue not found: {e}'
         })
 
-    print('... checking for messages ...')
+    picker = TierPicker(tiers,
+        starvation_seconds=config.getint('ANNOTATOR', 'StarvationSeconds', fallback=600))
 
-    while True:
-        try:
-            #  read a message from the sqs queue
-            queue = sqs.receive_message(
-            QueueUrl=queue_url, AttributeNames=['All'], MaxNumberOfMessages=1,
-            WaitTimeSeconds=20)
-            receipt_handle = queue["Messages"][0]["ReceiptHandle"]
-            message_json = json.loads(queue["Messages"][0]["Body"])
-            message = ast.literal_eval(message_json["Message"])
-        except KeyError:
-            # since there's no messages in the queue, keep listening...
-            continue
+    scheduler = JobScheduler(sqs, config.get('AWS', 'DynamoDBTable'), workers,
+        prefetch=config.getint('ANNOTATOR', 'PrefetchJobs', fallback=0),
+        download_threads=config.getint('ANNOTATOR', 'DownloadThreads', fallback=4),
+        lease_seconds=config.getint('ANNOTATOR', 'LeaseSeconds', fallback=300),
+        heartbeat_seconds=config.getint('ANNOTATOR', 'HeartbeatSeconds', fallback=60),
+        visibility_timeout=config.getint('ANNOTATOR', 'VisibilityTimeout', fallback=300),
+        max_attempts=config.getint('ANNOTATOR', 'MaxAttempts', fallback=5))
 
-        key = message['s3_key_input_file']
-        user_id = message['user_id']
-        uuid = message['job_id']
-        filename = message['input_file_name']
-        user_email = message['user_email']
-        bucket_name = message['s3_inputs_bucket']
+    poll_wait = config.getint('ANNOTATOR', 'PollWaitSeconds', fallback=1)
 
-        # Save the file in a unique path
-        dir_path = os.path.join(jobs_dir, user_id, uuid)
-        os.makedirs(dir_path, exist_ok=True)
-        file_path = os.path.join(dir_path, filename)
+    print('... checking for messages ...')
 
-        # Download the file from S3
-        download_file_from_s3(bucket_name, key, file_path)
-        print('File processed successfully with path', file_path)
-
-        dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-        ann_table = dynamodb.Table(config.get('AWS', 'DynamoDBTable'))
-        response = ann_table.get_item(Key={'job_id': uuid})
-        status = response['Item']['job_status']
-
-        # handle if the job is already complete
-        if status == 'COMPLETED':
-            sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=receipt_handle)
-            print("message deleted")
-            print("Job is already complete!")
-            continue
+    while True:
+        acks = scheduler.take_acks()
+        if len(acks) > 0:
+            delete_messages(sqs, acks)
 
-        try:
-            subprocess.Popen(['python', 'run.py', file_path, dir_path, user_id, uuid, user_email])
-        except subprocess.CalledProcessError as e:
-            print({'code': 500, 'status': 'error', 'message': f'Failed to launch annotation job: {str(e)}'})
+        # Backpressure: only take messages off the queue while there is
+        # room for them; until then, they stay in SQS for other instances
+        if not scheduler.wait_for_slot(timeout=1):
             continue
 
-        try:
-            ann_table.update_item(
-                Key={'job_id': uuid},
-                UpdateExpression='SET job_status = :new_status',
-                ConditionExpression='job_status = :current_status',
-                ExpressionAttributeValues={
-                    ':new_status': 'RUNNING',
-                    ':current_status': 'PENDING'
-                }
-            )
-        except botocore.exceptions.ClientError:
-            print({
-                'code': 'HTTP_500_INTERNAL_SERVER_ERROR',
-                'status': 'error',
-                'message': 'Cannot find that key'
-            })
-
-        sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=receipt_handle)
-        print("message deleted")
-        response = {
-            "code": 201,
-            "data": {
-                "job_id": uuid,
-                "input_file": filename
-            },
-            "status": "Success"
-        }
-        print(response)
+        #  read up to one message per free slot from the sqs queues, in
+        #  the picker's order: the first queue with messages gets the
+        #  slots. Every queue is long polled, the others for poll_wait
+        #  seconds and the last for a share of the 20 seconds, so that an
+        #  idle instance still looks at every queue
+        tiers = picker.order()
+        for (i, tier) in enumerate(tiers):
+            wait = poll_wait
+            if (i == len(tiers) - 1):
+                wait = max(poll_wait, 20 // len(tiers))
+            queue = sqs.receive_message(
+            QueueUrl=tier.queue_url, AttributeNames=['All'],
+            MaxNumberOfMessages=min(SQS_BATCH_SIZE, scheduler.free_slots()),
+            WaitTimeSeconds=wait)
+
+            # when there's no messages in the queue, keep listening...
+            messages = queue.get("Messages", [])
+            picker.read(tier, len(messages))
+            for sqs_message in messages:
+                scheduler.add(parse_job(sqs_message, tier))
+            if len(messages) > 0:
+                break
 
 
+# Returns whether the file was downloaded
 # https://awscli.amazonaws.com/v2/documentation/api/latest/reference/s3api/get-object.html
-def download_file_from_s3(bucket_name, key, file_path):
+def download_file_from_s3(bucket_name, key, file_path, s3_client=None):
     try:
-        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client = s3_client or boto3.client('s3', region_name='us-east-1')
         s3_client.download_file(bucket_name, key, file_path)
     except Exception as e:
         print(f"Error downloading file from S3: {str(e)}")
-        return None
+        return False
+    return True
 
 
 if __name__ == '__main__':
@@ -0,0 +1,217 @@
+# bgzf.py
+#
+# Compressed VCF input and BGZF-compressed annotated output
+#
+# Inputs ending in .gz (gzip or bgzip) are decompressed as a stream while
+# they are read. Outputs ending in .gz are written in BGZF, the blocked
+# gzip format of samtools/htslib: a series of independent gzip members of
+# at most 64kb of data each, with the compressed size of the member in a
+# "BC" extra field, followed by an empty end-of-file member. Any gzip
+# reader (gunzip, zcat, Python's gzip) reads it as one stream, while tabix
+# and friends can seek to the start of any block.
+#
+# Blocks are independent, so a writer flushed at a block boundary can be
+# truncated there and appended to later, which is what resuming from a
+# checkpoint does.
+#
+# write_index() adds a coordinate index next to a BGZF result, with which
+# the web app serves region queries from ranged S3 GETs.
+#
+##
+
+import os
+import gzip
+import json
+import zlib
+import struct
+
+# Largest amount of data per block, as in htslib
+BLOCK_SIZE = 0xff00
+
+HEADER = struct.Struct('<4sIBBHccHH')
+
+# Width in bases of the position bins of a result index, and its file
+# name suffix
+INDEX_BIN_WIDTH = 16384
+INDEX_SUFFIX = '.idx.json'
+INDEX_FORMAT_VERSION = 1
+
+# Empty block marking the end of a BGZF file
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+"""Whether path names a gzip/bgzip compressed file
+"""
+def is_compressed(path):
+    return path.endswith('.gz')
+
+
+"""One BGZF block holding data
+"""
+def compress_block(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = HEADER.pack(b'\x1f\x8b\x08\x04', 0, 0, 0xff, 6, b'B', b'C', 2,
+        HEADER.size + len(cdata) + 8 - 1)
+    return header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+        len(data))
+
+
+"""Text-mode writer of a BGZF file
+   With offset, an existing file is truncated to offset, which must be a
+   block boundary returned by tell() after flush(), and written on from
+   there
+"""
+class BgzfWriter(object):
+    def __init__(self, path, offset=None, level=6):
+        self.path = path
+        self.level = level
+        if offset is None:
+            self.fh = open(path, 'wb')
+        else:
+            self.fh = open(path, 'r+b')
+            self.fh.truncate(offset)
+            self.fh.seek(offset)
+        self.buffer = bytearray()
+
+    def write(self, text):
+        self.buffer.extend(text.encode('utf-8'))
+        while (len(self.buffer) >= BLOCK_SIZE):
+            self.fh.write(compress_block(bytes(self.buffer[:BLOCK_SIZE]),
+                level=self.level))
+            del self.buffer[:BLOCK_SIZE]
+
+    """Ends the current block and flushes the file
+    """
+    def flush(self):
+        if (len(self.buffer) > 0):
+            self.fh.write(compress_block(bytes(self.buffer), level=self.level))
+            self.buffer = bytearray()
+        self.fh.flush()
+
+    """Offset in the compressed file; a block boundary right after flush()
+    """
+    def tell(self):
+        return self.fh.tell()
+
+    def fileno(self):
+        return self.fh.fileno()
+
+    def close(self):
+        if self.fh.closed:
+            return
+        self.flush()
+        self.fh.write(EOF_BLOCK)
+        self.fh.close()
+
+
+"""Blocks of a BGZF file as (offset, size, data)
+"""
+def read_blocks(fh):
+    offset = 0
+    while True:
+        header = fh.read(HEADER.size)
+        if (len(header) < HEADER.size):
+            return
+        fields = HEADER.unpack(header)
+        if (fields[0] != b'\x1f\x8b\x08\x04' or fields[5:7] != (b'B', b'C')):
+            raise ValueError(f"Not a BGZF block at offset {offset}")
+        size = fields[8] + 1
+        body = fh.read(size - HEADER.size)
+        data = zlib.decompress(body[:-8], -15)
+        yield (offset, size, data)
+        offset = offset + size
+
+
+"""Coordinate index of a BGZF-compressed VCF, in the spirit of tabix
+   For every chromosome and every bin_width wide bin of positions, the
+   lines of the bin lie between the start of their first line, as the
+   offset of its block plus the offset of the line in the uncompressed
+   block, and the end of the block holding the end of their last line:
+   a region query fetches that byte range, decompresses it, skips to the
+   first line and filters the lines by position. Bins are kept per line,
+   so the index also holds for unsorted files
+   columns is the column header line
+"""
+def build_index(path, bin_width=INDEX_BIN_WIDTH):
+    index = {
+        'format_version': INDEX_FORMAT_VERSION,
+        'bin_width': bin_width,
+        'columns': None,
+        'chroms': {}
+    }
+    pending = bytearray()
+    line_start = None
+    with open(path, 'rb') as fh:
+        for (offset, size, data) in read_blocks(fh):
+            i = 0
+            while (i < len(data)):
+                if line_start is None:
+                    line_start = [offset, i]
+                nl = data.find(b'\n', i)
+                if (nl == -1):
+                    pending.extend(data[i:])
+                    break
+                pending.extend(data[i:nl])
+                _index_line(index, pending.decode('utf-8'), line_start,
+                    offset + size)
+                pending = bytearray()
+                line_start = None
+                i = nl + 1
+    return index
+
+
+def _index_line(index, line, line_start, block_end):
+    if (line.startswith('#') or line.startswith('CHROM')):
+        if (line.startswith('#CHROM') or line.startswith('CHROM')):
+            index['columns'] = line
+        return
+    fields = line.split('\t', 2)
+    if (len(fields) < 3):
+        return
+    key = str(int(fields[1]) // index['bin_width'])
+    bins = index['chroms'].setdefault(fields[0].strip(), {})
+    entry = bins.get(key)
+    if entry is None:
+        bins[key] = line_start + [block_end]
+    else:
+        if (line_start < entry[:2]):
+            entry[:2] = line_start
+        entry[2] = max(entry[2], block_end)
+
+
+"""Builds the index of the BGZF file at path and writes it next to it, as
+   <path>.idx.json; returns the index path
+"""
+def write_index(path, bin_width=INDEX_BIN_WIDTH):
+    index = build_index(path, bin_width=bin_width)
+    index_path = path + INDEX_SUFFIX
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump(index, fh, separators=(',', ':'))
+    os.replace(tmp_path, index_path)
+    return index_path
+
+
+"""Opens a VCF for reading as text, decompressing .gz files on the fly
+"""
+def open_input(path):
+    if is_compressed(path):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+
+"""Opens an output file for writing as text, in BGZF for .gz files
+   With offset, the file is truncated to offset and written on from there
+"""
+def open_output(path, offset=None):
+    if is_compressed(path):
+        return BgzfWriter(path, offset=offset)
+    if offset is None:
+        return open(path, 'w')
+    fh = open(path, 'r+')
+    fh.truncate(offset)
+    fh.seek(offset)
+    return fh
+
+### EOF
@@ -0,0 +1,151 @@
+# binning.py
+#
+# UCSC genome browser binning scheme
+#
+# Every record of a UCSC table is assigned the smallest bin of a fixed
+# hierarchy (128kb, 1Mb, 8Mb, 64Mb and 512Mb bins) that holds it entirely.
+# The records overlapping a range can then only be in the few bins of each
+# level that overlap the range, so a "bin IN (...)" predicate on a
+# (chrom, bin) index replaces a scan of the whole chromosome.
+#
+# Tables that come without a bin column get one, and the (chrom, bin)
+# index, with:  python binning.py [--tables T ...]
+#
+##
+
+import argparse
+
+import reference
+
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+
+"""Tables holding ranges, with the columns their bins are computed from
+   gwasCatalog is looked up on chromEnd only but binned on its full range;
+   the chrom_pos_* tables are looked up by position and stay unbinned.
+   The per chromosome tfbsConsSites tables are binned too
+"""
+BIN_TABLES = {
+    'refGene': ('txStart', 'txEnd'),
+    'cpgIslandExt': ('chromStart', 'chromEnd'),
+    'cytoBand': ('chromStart', 'chromEnd'),
+    'gadAll': ('chromStart', 'chromEnd'),
+    'gwasCatalog': ('chromStart', 'chromEnd'),
+    'targetScanS': ('chromStart', 'chromEnd'),
+    'hugo': ('chromStart', 'chromEnd'),
+    'dgv_Cnv': ('chromStart', 'chromEnd'),
+    'abParts_IG_T_CelReceptors': ('chromStart', 'chromEnd'),
+    'mcCarroll_Cnv': ('chromStart', 'chromEnd'),
+    'conrad_Cnv': ('chromStart', 'chromEnd'),
+    'genomicSuperDups': ('chromStart', 'chromEnd'),
+}
+
+"""Start and end columns table is binned on, or None if it is not binned
+"""
+def bin_columns(table):
+    if table.startswith('tfbsConsSites'):
+        return ('chromStart', 'chromEnd')
+    return BIN_TABLES.get(table)
+
+
+"""Bin of the record covering the 0-based half-open range [start, end)
+"""
+def bin_from_range(start, end):
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = (max(end, start + 1) - 1) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        if (start_bin == end_bin):
+            return offset + start_bin
+        start_bin = start_bin >> BIN_NEXT_SHIFT
+        end_bin = end_bin >> BIN_NEXT_SHIFT
+    raise ValueError(f"Range {start}-{end} is out of the binning scheme")
+
+
+"""All bins that can hold a record overlapping [start, end)
+"""
+def bins_for_range(start, end):
+    start = max(start, 0)
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = (max(end, start + 1) - 1) >> BIN_FIRST_SHIFT
+    bins = []
+    for offset in BIN_OFFSETS:
+        bins.extend(range(offset + start_bin, offset + end_bin + 1))
+        start_bin = start_bin >> BIN_NEXT_SHIFT
+        end_bin = end_bin >> BIN_NEXT_SHIFT
+    return bins
+
+
+"""Bins for an inclusive lookup of [lo, hi]
+   Tables mix 0- and 1-based and inclusive and exclusive ends, so the range
+   is widened by one on both sides: a record matching lo <= end and
+   start <= hi then always has its bin in the set
+"""
+def lookup_bins(lo, hi):
+    return bins_for_range(lo - 1, hi + 2)
+
+
+"""SQL expression computing bin_from_range from a table's own columns
+"""
+def bin_expression(start_col, end_col):
+    last = 'GREATEST(' + end_col + ', ' + start_col + ' + 1) - 1'
+    cases = []
+    shift = BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS[:-1]:
+        cases.append(f"WHEN ({start_col} >> {shift}) = (({last}) >> {shift}) " + \
+            f"THEN {offset} + ({start_col} >> {shift})")
+        shift = shift + BIN_NEXT_SHIFT
+    return 'CASE ' + ' '.join(cases) + ' ELSE 0 END'
+
+
+"""Adds a bin column and a (chrom, bin) index to table where missing
+"""
+def add_bin_index(conn, table):
+    chrom_col = reference.TABLES[table][0]
+    start_col, end_col = bin_columns(table)
+    cursor = conn.cursor()
+
+    cursor.execute('select * from ' + table + ' limit 0;')
+    columns = [d[0] for d in cursor.description]
+    if 'bin' not in columns:
+        print(f"{table}: adding bin column . . .")
+        # Appended last, so the stages' column positions do not move
+        cursor.execute('alter table ' + table + \
+            ' add column bin smallint unsigned not null default 0;')
+        cursor.execute('update ' + table + ' set bin = ' + \
+            bin_expression(start_col, end_col) + ';')
+        conn.commit()
+
+    index_columns = ([chrom_col] if chrom_col else []) + ['bin']
+    cursor.execute('show index from ' + table + ';')
+    indexes = {}
+    for row in cursor.fetchall():
+        # Key_name, Seq_in_index, Column_name
+        indexes.setdefault(row[2], {})[row[3]] = row[4]
+    for key in indexes.values():
+        if ([key[i] for i in sorted(key)][:len(index_columns)] == index_columns):
+            return
+
+    print(f"{table}: adding ({', '.join(index_columns)}) index . . .")
+    cursor.execute('create index ' + table + '_bin on ' + table + \
+        ' (' + ', '.join(index_columns) + ');')
+    conn.commit()
+    cursor.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Add UCSC bin columns and (chrom, bin) indexes')
+    parser.add_argument('--tables', nargs='*', help='tables to index')
+    args = parser.parse_args()
+
+    source = reference.MySQLSource()
+    try:
+        tables = args.tables or (sorted(BIN_TABLES.keys()) + \
+            ['tfbsConsSites' + c for c in reference.TFBS_CHROMS])
+        for table in tables:
+            add_bin_index(source.conn, table)
+    finally:
+        source.close()
+
+### EOF
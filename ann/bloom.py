@@ -0,0 +1,168 @@
+# bloom.py
+#
+# Bloom filter over the dbSNP table
+#
+# Most variants of tumor and rare disease uploads are not in dbSNP, yet
+# every one of them costs a database lookup that returns nothing. The
+# filter holds one key per dbSNP record (chromosome, position and REF) in a
+# bit array; a variant whose keys are not in it is certainly not in dbSNP
+# and is never looked up. False positives only cost the lookup they would
+# have cost anyway.
+#
+# File layout: magic, format version, number of bits, number of hashes,
+# reference version, then the bit array, which is memory-mapped on load.
+#
+# Build a filter with:  python bloom.py <file> [--fpr 0.01] [--max-mb 512]
+#
+##
+
+import os
+import math
+import mmap
+import struct
+import hashlib
+import argparse
+import threading
+
+import reference
+import utils as u
+
+MAGIC = b'ANNBLOOM'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<8sIQI')
+
+
+"""Key of a dbSNP record or variant: chromosome without "chr", position
+   and upper-cased REF, since lookups match REF case-insensitively
+"""
+def dbsnp_key(chrom, pos, ref):
+    if chrom.startswith('chr'):
+        chrom = chrom.replace('chr', '')
+    return f"{chrom}:{int(pos)}:{str(ref).upper()}".encode('utf-8')
+
+
+"""Number of bits and hashes giving false positive rate fpr for n keys,
+   with the bit array capped at max_bytes
+"""
+def filter_size(n, fpr=0.01, max_bytes=None):
+    n = max(1, n)
+    bits = int(math.ceil(-n * math.log(fpr) / (math.log(2) ** 2)))
+    if max_bytes:
+        bits = min(bits, int(max_bytes) * 8)
+    bits = max(64, bits)
+    hashes = max(1, int(round((bits / float(n)) * math.log(2))))
+    return (bits, hashes)
+
+
+class BloomFilter(object):
+    def __init__(self, num_bits, num_hashes, bits=None, version=''):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.version = version
+        self.bits = bits if bits is not None else \
+            bytearray((num_bits + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for p in self._positions(key):
+            self.bits[p >> 3] |= (1 << (p & 7))
+
+    def __contains__(self, key):
+        for p in self._positions(key):
+            if not (self.bits[p >> 3] & (1 << (p & 7))):
+                return False
+        return True
+
+    def save(self, path):
+        version = str(self.version).encode('utf-8')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fh:
+            fh.write(HEADER.pack(MAGIC, FORMAT_VERSION, self.num_bits,
+                self.num_hashes))
+            fh.write(struct.pack('<I', len(version)) + version)
+            fh.write(self.bits)
+        os.replace(tmp_path, path)
+
+
+"""Loads a filter file, memory-mapping its bit array
+"""
+def load_filter(path):
+    with open(path, 'rb') as fh:
+        m = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, format_version, num_bits, num_hashes = HEADER.unpack_from(m, 0)
+    if (magic != MAGIC or format_version != FORMAT_VERSION):
+        raise ValueError(f"Unsupported Bloom filter format in '{path}'")
+    offset = HEADER.size
+    (length,) = struct.unpack_from('<I', m, offset)
+    version = bytes(m[offset + 4:offset + 4 + length]).decode('utf-8')
+    offset = offset + 4 + length
+    return BloomFilter(num_bits, num_hashes, bits=memoryview(m)[offset:],
+        version=version)
+
+
+"""Builds the dbSNP filter from source and writes it to path
+"""
+def build_dbsnp_filter(source, path, fpr=0.01, max_bytes=None, version=None):
+    num_bits, num_hashes = filter_size(source.count('dbSNP'), fpr=fpr,
+        max_bytes=max_bytes)
+    bloom = BloomFilter(num_bits, num_hashes,
+        version=version or reference.version())
+    ref_ind = source.column_index('dbSNP', 'REF')
+    for (chrom, start, end, seq, row) in source.scan('dbSNP'):
+        bloom.add(dbsnp_key(chrom, start, str(row[ref_ind])))
+    bloom.save(path)
+    return bloom
+
+
+_filters = {}
+_filters_lock = threading.Lock()
+
+"""Returns the process-wide dbSNP filter at path, or None when it was
+   built from another reference version than the one in use: a stale
+   filter could hide records added since. Filters of an older format are
+   ignored the same way
+"""
+def open_dbsnp_filter(path):
+    with _filters_lock:
+        if path not in _filters:
+            try:
+                bloom = load_filter(path)
+            except ValueError as e:
+                print(f"Ignoring dbSNP filter {path}: {str(e)}")
+                _filters[path] = None
+                return None
+            if (bloom.version != str(reference.version())):
+                print(f"Ignoring dbSNP filter {path}: built for reference " + \
+                    f"version {bloom.version}, not {reference.version()}")
+                bloom = None
+            _filters[path] = bloom
+        return _filters[path]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build the Bloom filter screening dbSNP lookups')
+    parser.add_argument('path', help='filter file to create')
+    parser.add_argument('--fpr', type=float,
+        default=u.config.getfloat('ANNOTATE', 'DbSnpFilterFPR', fallback=0.01),
+        help='target false positive rate')
+    parser.add_argument('--max-mb', type=int,
+        default=u.config.getint('ANNOTATE', 'DbSnpFilterMaxMB', fallback=512),
+        help='largest bit array size in MB')
+    args = parser.parse_args()
+
+    source = reference.connect()
+    try:
+        bloom = build_dbsnp_filter(source, args.path, fpr=args.fpr,
+            max_bytes=args.max_mb * 1024 * 1024)
+    finally:
+        source.close()
+    print(f"dbSNP filter ({bloom.num_bits} bits, {bloom.num_hashes} hashes) " + \
+        f"written to {args.path}")
+
+### EOF
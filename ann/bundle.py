@@ -0,0 +1,281 @@
+# bundle.py
+#
+# Offline reference bundle for the annotator
+#
+# The reference tables change rarely, so they can be exported once into a
+# versioned directory and memory-mapped by every annotator instance:
+#
+#   manifest.json        format version, reference version, table layouts
+#   <table>/<n>.start    int64 record starts, sorted (one set per chromosome)
+#   <table>/<n>.end      int64 record ends, in the same order
+#   <table>/<n>.maxend   int64 running maximum of the ends
+#   <table>/<n>.offset   int64 offsets of each record in the payload, plus one
+#   <table>/<n>.seq      int64 position of each record in the table's row order
+#   <table>/<n>.dat      payload blob of pickled table rows
+#
+# Lookups binary search the mmap'd arrays: records covering [lo, hi] lie
+# between the first maxend >= lo and the last start <= hi. They are
+# returned in the table's row order, as from MySQL (see
+# reference.row_order), so switching the backend does not change the
+# annotations.
+#
+# Build a bundle with:  python bundle.py <path> [--version V] [--tables T ...]
+#
+##
+
+import os
+import json
+import mmap
+import time
+import pickle
+import shutil
+import argparse
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+import reference
+
+FORMAT_VERSION = 2
+MANIFEST = 'manifest.json'
+ARRAYS = ['start', 'end', 'maxend', 'offset', 'seq']
+
+
+"""Writes the arrays and payload of one chromosome of one table
+"""
+class _ChromWriter(object):
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.files = dict([(a, open(prefix + '.' + a, 'wb')) for a in ARRAYS])
+        self.payload = open(prefix + '.dat', 'wb')
+        self.buffers = dict([(a, array('q')) for a in ARRAYS])
+        self.maxend = -1
+        self.offset = 0
+        self.count = 0
+        self.buffers['offset'].append(0)
+
+    def add(self, start, end, seq, row):
+        blob = pickle.dumps(row, protocol=pickle.HIGHEST_PROTOCOL)
+        self.payload.write(blob)
+        self.offset = self.offset + len(blob)
+        self.maxend = max(self.maxend, end)
+        self.buffers['start'].append(start)
+        self.buffers['end'].append(end)
+        self.buffers['maxend'].append(self.maxend)
+        self.buffers['offset'].append(self.offset)
+        self.buffers['seq'].append(seq)
+        self.count = self.count + 1
+        if (len(self.buffers['start']) >= 65536):
+            self.flush()
+
+    def flush(self):
+        for a in ARRAYS:
+            self.buffers[a].tofile(self.files[a])
+            self.buffers[a] = array('q')
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.payload.close()
+
+
+"""Exports reference tables from source into a new bundle at path
+   Records of each chromosome must arrive sorted by start, which is what
+   MySQLSource.scan() returns
+"""
+def build_bundle(source, path, version=None, tables=None):
+    tables = tables or sorted(reference.TABLES.keys())
+    tmp_path = path + '.tmp'
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'reference_version': version or time.strftime('%Y%m%d%H%M%S'),
+        'created': int(time.time()),
+        'tables': {}
+    }
+
+    for table in tables:
+        print(f"Exporting {table} . . .")
+        os.makedirs(os.path.join(tmp_path, table))
+        chroms = {}
+        writer = None
+        for (chrom, start, end, seq, row) in source.scan(table):
+            if (writer is None or chrom not in chroms):
+                if writer is not None:
+                    writer.close()
+                n = str(len(chroms))
+                writer = _ChromWriter(os.path.join(tmp_path, table, n))
+                chroms[chrom] = {'file': n, 'writer': writer}
+            elif (chroms[chrom]['writer'] is not writer):
+                raise ValueError(f"{table}: records of '{chrom}' are not contiguous")
+            writer.add(start, end, seq, row)
+        if writer is not None:
+            writer.close()
+
+        manifest['tables'][table] = {
+            'columns': source.columns(table),
+            'chroms': dict([(c, {'file': v['file'], 'count': v['writer'].count})
+                for c, v in chroms.items()])
+        }
+
+    with open(os.path.join(tmp_path, MANIFEST), 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return manifest
+
+
+"""Memory-mapped view of one chromosome of one table
+"""
+class _ChromIndex(object):
+    def __init__(self, prefix, count):
+        self.count = count
+        self.maps = []
+        for a in ARRAYS:
+            setattr(self, a, self._map(prefix + '.' + a).cast('q'))
+        self.payload = self._map(prefix + '.dat')
+
+    def _map(self, filename):
+        with open(filename, 'rb') as fh:
+            if (os.fstat(fh.fileno()).st_size == 0):
+                return memoryview(b'')
+            m = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps.append(m)
+        return memoryview(m)
+
+    """Record numbers of all records with start <= hi and end >= lo,
+       in row order
+    """
+    def overlapping(self, lo, hi):
+        first = bisect_left(self.maxend, lo)
+        last = bisect_right(self.start, hi)
+        return reference.row_order([(self.seq[i], i)
+            for i in range(first, last) if self.end[i] >= lo])
+
+    def row(self, i):
+        return pickle.loads(self.payload[self.offset[i]:self.offset[i + 1]])
+
+
+"""Reader for a reference bundle; answers the same lookups as
+   reference.MySQLSource without touching the network
+"""
+class Bundle(object):
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as fh:
+            self.manifest = json.load(fh)
+        if (self.manifest.get('format_version') != FORMAT_VERSION):
+            raise ValueError(f"Unsupported reference bundle format in '{path}'")
+
+        self.version = self.manifest['reference_version']
+        self._chroms = {}
+        self._lock = threading.Lock()
+
+    def columns(self, table):
+        return self.manifest['tables'][table]['columns']
+
+    def column_index(self, table, column):
+        return self.columns(table).index(column)
+
+    def count(self, table):
+        return sum([c['count'] for c in
+            self.manifest['tables'][table]['chroms'].values()])
+
+    def _index(self, table, chrom):
+        if reference.TABLES[table][0] is None:
+            chrom = ''
+        key = (table, chrom)
+        if key not in self._chroms:
+            with self._lock:
+                if key not in self._chroms:
+                    meta = self.manifest['tables'][table]['chroms'].get(chrom)
+                    index = None
+                    if meta is not None:
+                        index = _ChromIndex(os.path.join(self.path, table,
+                            meta['file']), meta['count'])
+                    self._chroms[key] = index
+        return self._chroms[key]
+
+    def lookup(self, table, chrom, pos, offset=0, where=None, columns=None,
+        limit=None):
+        index = self._index(table, chrom)
+        if index is None:
+            return []
+        pos = int(pos)
+        rows = [index.row(i) for i in
+            index.overlapping(pos - offset, pos + offset)]
+        rows = reference.filter_rows(self.columns(table), rows, where,
+            columns)
+        if limit is not None:
+            rows = rows[:limit]
+        return rows
+
+    def lookup_range(self, table, chrom, lo, hi):
+        index = self._index(table, chrom)
+        if index is None:
+            return []
+        return [(index.start[i], index.end[i], index.row(i))
+            for i in index.overlapping(int(lo), int(hi))]
+
+    def lookup_batch(self, table, chrom, positions, where=None,
+        columns=None):
+        hits = {}
+        for pos in set([int(p) for p in positions]):
+            rows = self.lookup(table, chrom, pos, where=where, columns=columns)
+            if (len(rows) > 0):
+                hits[pos] = rows
+        return hits
+
+    def scan(self, table, chrom=None):
+        chroms = self.manifest['tables'][table]['chroms']
+        if chrom is not None:
+            chroms = [chrom]
+        for chrom in chroms:
+            index = self._index(table, chrom)
+            if index is None:
+                continue
+            for i in range(index.count):
+                yield (chrom, index.start[i], index.end[i], index.seq[i],
+                    index.row(i))
+
+    """Bundles are shared by every stage in the process; nothing to close
+    """
+    def close(self):
+        pass
+
+
+_bundles = {}
+_bundles_lock = threading.Lock()
+
+"""Returns the process-wide reader for the bundle at path
+"""
+def open_bundle(path):
+    with _bundles_lock:
+        if path not in _bundles:
+            _bundles[path] = Bundle(path)
+        return _bundles[path]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export the annotator reference tables into a bundle')
+    parser.add_argument('path', help='bundle directory to create')
+    parser.add_argument('--version', help='reference data version label')
+    parser.add_argument('--tables', nargs='*', help='tables to export')
+    args = parser.parse_args()
+
+    source = reference.MySQLSource()
+    try:
+        manifest = build_bundle(source, args.path, version=args.version,
+            tables=args.tables)
+    finally:
+        source.close()
+    print(f"Reference bundle {manifest['reference_version']} written to {args.path}")
+
+### EOF
@@ -0,0 +1,108 @@
+# checkpoint.py
+#
+# Checkpoints of a running annotation pass, for resuming after a crash
+#
+# Every stage is applied in the same pass, so a job has no per-stage
+# output to resume from; instead the pass records how far it got. Every
+# CheckpointChunks flushed chunks, the output is synced to disk and a small
+# JSON manifest is written next to the input (<input>.checkpoint) with:
+#
+#   input_offset    where reading resumes in the input
+#   output_offset   how much of the output is complete
+#   counts          the counters of every stage so far
+#   cache           variant cache hits and misses so far
+#   memo            lines and variants looked up so far by the in-job memo
+#
+# When a job is restarted on the same directory (the instance was killed
+# and SQS delivered the message again) and the manifest matches the input
+# size and the stage list, the output is truncated to output_offset and the
+# pass continues from input_offset. The manifest is removed once the job
+# log is written.
+#
+##
+
+import os
+import json
+
+import reference
+import utils as u
+import variant_cache
+
+FORMAT_VERSION = 2
+
+
+class Checkpoint(object):
+    def __init__(self, path, infile, signature, every=10):
+        self.path = path
+        self.infile = infile
+        self.signature = signature
+        self.every = max(1, int(every))
+        self.chunks = 0
+
+    """Saved state of an interrupted pass over the same input with the
+       same stages, or None when there is nothing valid to resume
+    """
+    def load(self, outfile):
+        if not (os.path.exists(self.path) and os.path.exists(outfile)):
+            return None
+        try:
+            with open(self.path) as fh:
+                state = json.load(fh)
+        except ValueError:
+            return None
+        if (state.get('format_version') != FORMAT_VERSION or
+            state.get('signature') != self.signature or
+            state.get('input_size') != os.path.getsize(self.infile) or
+            state.get('output_offset', -1) > os.path.getsize(outfile)):
+            return None
+        return state
+
+    """Called after every flushed chunk; every self.every chunks, syncs
+       fh_out and records the state of the pass
+    """
+    def chunk_done(self, input_offset, fh_out, stages, cache=None,
+        memo=None):
+        self.chunks = self.chunks + 1
+        if (self.chunks % self.every != 0):
+            return
+        fh_out.flush()
+        os.fsync(fh_out.fileno())
+        self.save(input_offset, fh_out.tell(), stages, cache=cache,
+            memo=memo)
+
+    def save(self, input_offset, output_offset, stages, cache=None,
+        memo=None):
+        state = {
+            'format_version': FORMAT_VERSION,
+            'signature': self.signature,
+            'input_size': os.path.getsize(self.infile),
+            'input_offset': input_offset,
+            'output_offset': output_offset,
+            'counts': [dict(stage.counts) for stage in stages],
+            'cache': [cache.hits, cache.misses] if cache is not None else None,
+            'memo': [memo.lines, memo.lookups] if memo is not None else None
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump(state, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+"""Checkpoint of the pass annotating infile with stages, or None when
+   CheckpointChunks is 0
+"""
+def open_checkpoint(infile, stages):
+    every = u.config.getint('ANNOTATE', 'CheckpointChunks', fallback=0)
+    if (every <= 0):
+        return None
+    return Checkpoint(infile + '.checkpoint', infile,
+        variant_cache.cache_signature(stages, reference.version()),
+        every=every)
+
+### EOF
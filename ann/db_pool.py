@@ -0,0 +1,145 @@
+# db_pool.py
+#
+# Process-wide pool of reference database connections
+#
+# Opening a connection costs a TCP and MySQL auth handshake (and used to
+# cost a Secrets Manager call too), so connections are handed back to the
+# pool when a stage is done with them and reused by later stages and jobs
+# in the same process. Idle connections are pinged before reuse once they
+# have been idle for HealthCheckInterval seconds; broken ones are dropped.
+# Pool settings live in the [DATABASE] section of ann_config.ini
+#
+##
+
+import os
+import time
+import threading
+
+import pymysql
+
+import utils as u
+
+
+"""Pool of at most max_size open connections
+"""
+class ConnectionPool(object):
+    def __init__(self, max_size=16, health_check_interval=30, timeout=60,
+        connect=None):
+        self.max_size = max(1, int(max_size))
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+        self.connect = connect or u.db_connect
+        self.pid = os.getpid()
+        self.idle = []
+        self.size = 0
+        self.cond = threading.Condition()
+
+    """Raises ValueError when needed connections cannot be held at once
+    """
+    def check_capacity(self, needed):
+        if (needed > self.max_size):
+            raise ValueError(f"A pass of {needed} stages holds {needed} " + \
+                f"reference database connections at once, but PoolSize " + \
+                f"is {self.max_size}; raise PoolSize to at least {needed}")
+
+    def _healthy(self, conn, idle_since):
+        if (time.time() - idle_since < self.health_check_interval):
+            return True
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except pymysql.err.Error:
+            return False
+
+    """Returns an open connection, waiting up to timeout seconds when
+       max_size connections are already in use
+    """
+    def acquire(self):
+        deadline = time.time() + self.timeout
+        with self.cond:
+            while True:
+                while (len(self.idle) > 0):
+                    conn, idle_since = self.idle.pop()
+                    if self._healthy(conn, idle_since):
+                        return conn
+                    self._close(conn)
+                    self.size = self.size - 1
+
+                if (self.size < self.max_size):
+                    self.size = self.size + 1
+                    break
+
+                remaining = deadline - time.time()
+                if (remaining <= 0):
+                    raise RuntimeError(f"No reference database connection " + \
+                        f"available after {self.timeout}s (PoolSize = {self.max_size})")
+                self.cond.wait(remaining)
+
+        try:
+            return self.connect()
+        except Exception:
+            with self.cond:
+                self.size = self.size - 1
+                self.cond.notify()
+            raise
+
+    """Hands a connection back; its open transaction is rolled back so the
+       next user does not read from an old snapshot
+    """
+    def release(self, conn):
+        try:
+            conn.rollback()
+            healthy = True
+        except pymysql.err.Error:
+            healthy = False
+
+        with self.cond:
+            if healthy:
+                self.idle.append((conn, time.time()))
+            else:
+                self._close(conn)
+                self.size = self.size - 1
+            self.cond.notify()
+
+    """Closes a connection that must not be reused
+    """
+    def discard(self, conn):
+        self._close(conn)
+        with self.cond:
+            self.size = self.size - 1
+            self.cond.notify()
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except pymysql.err.Error:
+            pass
+
+    def close(self):
+        with self.cond:
+            for conn, idle_since in self.idle:
+                self._close(conn)
+            self.size = self.size - len(self.idle)
+            self.idle = []
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+"""Returns the connection pool of this process
+   A process forked from one that already had a pool gets its own: the
+   inherited sockets belong to the parent
+"""
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if (_pool is None or _pool.pid != os.getpid()):
+            _pool = ConnectionPool(
+                max_size=u.config.getint('DATABASE', 'PoolSize', fallback=16),
+                health_check_interval=u.config.getint('DATABASE',
+                    'HealthCheckInterval', fallback=30),
+                timeout=u.config.getint('DATABASE', 'PoolTimeout',
+                    fallback=60))
+        return _pool
+
+### EOF
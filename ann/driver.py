@@ -10,112 +10,88 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
-import sys
-import os
-import file_utils as fu
 import annotate as ann
-
+import shard
+import bgzf
+import checkpoint
+import reference
+import variant_cache
+import utils as u
+
+"""Annotation stages in the order they are applied to every variant
+"""
+def build_stages(format='vcf'):
+    return [
+        ann.DbSnpStage(format=format, batch_size=u.config.getint('ANNOTATE',
+            'DbSnpBatchSize', fallback=2000),
+            bloom_filter=u.config.get('ANNOTATE', 'DbSnpFilterPath',
+                fallback='')),
+        ann.BigRefGeneStage(format=format),
+        ann.GenesStage(format=format, table='refGene', promoter_offset=500,
+            segment_map=u.config.get('ANNOTATE', 'SegmentMapPath',
+                fallback='')),
+        ann.CytobandStage(format=format, table='cytoBand'),
+        ann.GadAllStage(format=format, table='gadAll'),
+        ann.GwasCatalogStage(format=format, table='gwasCatalog'),
+        ann.MiRNAStage(format=format, table='targetScanS'),
+        ann.HugoStage(format=format, table='hugo'),
+        ann.CnvStage(format=format, table='dgv_Cnv'),
+        ann.CnvStage(format=format, table='abParts_IG_T_CelReceptors'),
+        ann.CnvStage(format=format, table='mcCarroll_Cnv'),
+        ann.CnvStage(format=format, table='conrad_Cnv'),
+        ann.GenomicSuperDupsStage(format=format, table='genomicSuperDups'),
+        ann.TfbsConsSitesStage(format=format, table='tfbsConsSites')
+    ]
+
+
+"""Annotates infile in a single pass: every variant goes through all
+   stages in memory and the result is written straight to <name>.annot.vcf
+   (BGZF-compressed <name>.annot.vcf.gz with CompressResults, indexed by
+   position in <name>.annot.vcf.gz.idx.json); infile may be gzip/bgzip
+   compressed
+   With ShardMode set, the pass is split over a pool of processes;
+   otherwise, with CheckpointChunks set, an interrupted pass is resumed
+"""
 def run(infile, format):
 
     print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + '.' + str(i))
-
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    # x.vcf and x.vcf.gz both give x.annot.vcf[.gz] and x.vcf.count.log
+    base = infile[:-3] if bgzf.is_compressed(infile) else infile
+    finalout = (base + '.annot').replace('.vcf.annot', '.annot.vcf')
+    if u.config.getboolean('ANNOTATE', 'CompressResults', fallback=False):
+        finalout = finalout + '.gz'
+    logfile = base + '.count.log'
+    chunk_size = u.config.getint('ANNOTATE', 'ChunkSize', fallback=2000)
+    workers = u.config.getint('ANNOTATE', 'StageWorkers', fallback=0)
+    shard_mode = u.config.get('ANNOTATE', 'ShardMode', fallback='none')
+
+    if shard_mode in shard.SHARD_MODES:
+        shard.run_sharded(infile, finalout, build_stages,
+            logfile, logmode='w', format='vcf', mode=shard_mode,
+            shard_size=u.config.getint('ANNOTATE', 'ShardSize',
+                fallback=10000000),
+            processes=u.config.getint('ANNOTATE', 'ShardProcesses',
+                fallback=0),
+            chunk_size=chunk_size, workers=workers)
+    else:
+        stages = build_stages(format='vcf')
+        cache = variant_cache.open_cache(stages)
+        try:
+            ann.runStages(infile, finalout, stages, logfile,
+                logmode='w', chunk_size=chunk_size, format='vcf',
+                workers=workers, cache=cache, memo=variant_cache.open_memo(),
+                checkpoint=checkpoint.open_checkpoint(infile,
+                    stages))
+        finally:
+            if cache is not None:
+                cache.close()
+    if bgzf.is_compressed(finalout):
+        bgzf.write_index(finalout)
+    print("Annotation - done.")
+
+    # Statements run by this process, by query shape
+    for label, count in sorted(reference.query_counts().items()):
+        print(f"{label}: {count} queries")
 
 ### EOF
\ No newline at end of file
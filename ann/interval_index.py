@@ -0,0 +1,171 @@
+# interval_index.py
+#
+# In-memory interval index for point-in-region lookups
+#
+# Records of each chromosome are kept in a nested containment list
+# (Alekseyenko & Lee, 2007): intervals are sorted by start, every interval
+# contained in another one is moved into its parent's sublist, so within a
+# sublist both starts and ends are sorted and the overlapping records form
+# one contiguous run found by binary search. A query touching k records
+# costs O(log n + k).
+#
+##
+
+import threading
+from bisect import bisect_left
+
+import reference
+
+
+"""Nested containment list over the records of one chromosome
+   records is an iterable of (start, end, item); overlap queries return the
+   items in the order the records were added
+"""
+class IntervalIndex(object):
+    def __init__(self, records):
+        records = [(start, end, seq, item) for seq, (start, end, item)
+            in enumerate(records)]
+        records.sort(key=lambda r: (r[0], -r[1], r[2]))
+
+        self.items = [r[3] for r in records]
+        self.seqs = [r[2] for r in records]
+        self.starts = [r[0] for r in records]
+        self.ends = [r[1] for r in records]
+
+        # sublists[0] is the top level list; children[i] is the sublist
+        # holding the records contained in record i, or -1
+        self.sublists = [[]]
+        self.children = [-1] * len(records)
+        parents = []
+        for i in range(len(records)):
+            while (len(parents) > 0 and self.ends[parents[-1]] < self.ends[i]):
+                parents.pop()
+            if (len(parents) == 0):
+                self.sublists[0].append(i)
+            else:
+                parent = parents[-1]
+                if (self.children[parent] == -1):
+                    self.children[parent] = len(self.sublists)
+                    self.sublists.append([])
+                self.sublists[self.children[parent]].append(i)
+            parents.append(i)
+
+        self.sublist_ends = [[self.ends[i] for i in sub]
+            for sub in self.sublists]
+
+    def __len__(self):
+        return len(self.items)
+
+    """Items of all records with start <= hi and end >= lo
+    """
+    def overlapping(self, lo, hi):
+        hits = []
+        pending = [0]
+        while (len(pending) > 0):
+            s = pending.pop()
+            sub = self.sublists[s]
+            k = bisect_left(self.sublist_ends[s], lo)
+            while (k < len(sub) and self.starts[sub[k]] <= hi):
+                i = sub[k]
+                hits.append(i)
+                if (self.children[i] != -1):
+                    pending.append(self.children[i])
+                k = k + 1
+        hits.sort(key=lambda i: self.seqs[i])
+        return [self.items[i] for i in hits]
+
+
+"""Per chromosome interval indexes over a whole reference table
+   records are scanned (chrom, start, end, seq, row); the indexes are built
+   in row order, so lookups return rows in the order MySQL would
+"""
+class TableIndex(object):
+    def __init__(self, table, columns, records):
+        self.table = table
+        self.columns = columns
+        by_chrom = {}
+        for (chrom, start, end, seq, row) in records:
+            by_chrom.setdefault(chrom, []).append((seq, (start, end, row)))
+        self.chroms = dict([(chrom, IntervalIndex(reference.row_order(recs)))
+            for chrom, recs in by_chrom.items()])
+
+    def overlapping(self, chrom, lo, hi):
+        if reference.TABLES[self.table][0] is None:
+            chrom = ''
+        index = self.chroms.get(chrom)
+        if index is None:
+            return []
+        return index.overlapping(lo, hi)
+
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+"""Returns the process-wide index of table, loading it from source on
+   first use; key separates indexes loaded from different backends
+"""
+def get_table_index(source, table, key=None):
+    key = (key, table)
+    with _tables_lock:
+        if key not in _tables:
+            _tables[key] = TableIndex(table, source.columns(table),
+                source.scan(table))
+        return _tables[key]
+
+
+"""Reference source answering lookups on selected tables from in-memory
+   interval indexes and passing everything else through to source
+"""
+class IndexedSource(object):
+    def __init__(self, source, tables, key=None):
+        self.source = source
+        self.tables = set(tables)
+        self.key = key
+
+    def columns(self, table):
+        return self.source.columns(table)
+
+    def column_index(self, table, column):
+        return self.source.column_index(table, column)
+
+    def count(self, table):
+        return self.source.count(table)
+
+    def lookup(self, table, chrom, pos, offset=0, where=None, columns=None,
+        limit=None):
+        if table not in self.tables:
+            return self.source.lookup(table, chrom, pos, offset=offset,
+                where=where, columns=columns, limit=limit)
+
+        index = get_table_index(self.source, table, key=self.key)
+        pos = int(pos)
+        rows = reference.filter_rows(index.columns,
+            index.overlapping(chrom, pos - offset, pos + offset),
+            where, columns)
+        if limit is not None:
+            rows = rows[:limit]
+        return rows
+
+    def lookup_batch(self, table, chrom, positions, where=None,
+        columns=None):
+        if table not in self.tables:
+            return self.source.lookup_batch(table, chrom, positions,
+                where=where, columns=columns)
+
+        hits = {}
+        for pos in set([int(p) for p in positions]):
+            rows = self.lookup(table, chrom, pos, where=where, columns=columns)
+            if (len(rows) > 0):
+                hits[pos] = rows
+        return hits
+
+    def lookup_range(self, table, chrom, lo, hi):
+        return self.source.lookup_range(table, chrom, lo, hi)
+
+    def scan(self, table, chrom=None):
+        return self.source.scan(table, chrom=chrom)
+
+    def close(self):
+        self.source.close()
+
+### EOF
@@ -0,0 +1,117 @@
+# prefetch.py
+#
+# Windowed range prefetch for position-sorted VCFs
+#
+# VCFs arrive sorted by chromosome and position, but stages look up one
+# position at a time. For the tables it prefetches, WindowedSource reads
+# every record overlapping a whole window of a chromosome (PrefetchWindow
+# bases, widened by the largest lookup offset seen, e.g. the refGene
+# promoter offset) with one range query, answers the lookups falling in
+# that window from an in-memory interval index and drops it when the
+# stream moves on. Only one window per table is held at a time.
+#
+# If a lookup goes back to an earlier window or to a chromosome already
+# left behind, the input is not sorted: the table falls back to the
+# per-variant lookups of the wrapped source for the rest of the job, which
+# the job log notes.
+#
+##
+
+import reference
+from interval_index import IntervalIndex
+
+
+"""Window of one table currently held in memory
+"""
+class _Window(object):
+    def __init__(self, chrom, number, margin, index):
+        self.chrom = chrom
+        self.number = number
+        self.margin = margin
+        self.index = index
+
+
+class WindowedSource(object):
+    def __init__(self, source, tables, window_size=1000000):
+        self.source = source
+        self.tables = set(tables)
+        self.window_size = max(1, int(window_size))
+        self.windows = {}
+        self.passed = {}
+        self.unsorted = set()
+
+    def prefetched(self, table):
+        if table in self.unsorted:
+            return False
+        return (table in self.tables or (table.startswith('tfbsConsSites')
+            and 'tfbsConsSites' in self.tables))
+
+    def columns(self, table):
+        return self.source.columns(table)
+
+    def column_index(self, table, column):
+        return self.source.column_index(table, column)
+
+    def count(self, table):
+        return self.source.count(table)
+
+    """Window of table holding chrom:pos with room for offset, fetched if
+       needed; None once the table turned out to be read out of order
+    """
+    def _window(self, table, chrom, pos, offset):
+        number = pos // self.window_size
+        window = self.windows.get(table)
+        if (window is not None and window.chrom == chrom and
+            window.number == number and window.margin >= offset):
+            return window
+
+        passed = self.passed.setdefault(table, set())
+        if (window is not None and ((window.chrom == chrom and
+            window.number > number) or chrom in passed)):
+            self.unsorted.add(table)
+            self.windows.pop(table, None)
+            return None
+        if (window is not None and window.chrom != chrom):
+            passed.add(window.chrom)
+
+        margin = max(offset, window.margin if window is not None else 0)
+        lo = number * self.window_size - margin
+        hi = (number + 1) * self.window_size - 1 + margin
+        window = _Window(chrom, number, margin, IntervalIndex(
+            self.source.lookup_range(table, chrom, lo, hi)))
+        self.windows[table] = window
+        return window
+
+    def lookup(self, table, chrom, pos, offset=0, where=None, columns=None,
+        limit=None):
+        window = None
+        if self.prefetched(table):
+            window = self._window(table, chrom, int(pos), int(offset))
+        if window is None:
+            return self.source.lookup(table, chrom, pos, offset=offset,
+                where=where, columns=columns, limit=limit)
+
+        pos = int(pos)
+        rows = reference.filter_rows(self.columns(table),
+            window.index.overlapping(pos - offset, pos + offset),
+            where, columns)
+        if limit is not None:
+            rows = rows[:limit]
+        return rows
+
+    def lookup_batch(self, table, chrom, positions, where=None,
+        columns=None):
+        return self.source.lookup_batch(table, chrom, positions, where=where,
+            columns=columns)
+
+    def lookup_range(self, table, chrom, lo, hi):
+        return self.source.lookup_range(table, chrom, lo, hi)
+
+    def scan(self, table, chrom=None):
+        return self.source.scan(table, chrom=chrom)
+
+    def close(self):
+        self.windows = {}
+        self.source.close()
+
+### EOF
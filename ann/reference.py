@@ -0,0 +1,450 @@
+# reference.py
+#
+# Reference data sources used by the annotation stages
+#
+# Every stage asks the same kind of question: which records of a table
+# cover a position on a chromosome. A source answers that question either
+# from the live MySQL database or from an offline bundle (see bundle.py);
+# the backend is selected with ReferenceBackend in ann_config.ini
+#
+##
+
+import threading
+from collections import Counter
+
+import pymysql
+
+import utils as u
+import db_pool
+import binning
+
+"""Layout of the reference tables: chromosome column, start and end columns
+   A position matches a record when start <= pos <= end; point lookups use
+   the same column for start and end. The tfbsConsSites data is split into
+   one table per chromosome, so those tables have no chromosome column
+"""
+TABLES = {
+    'dbSNP': ('CHR', 'POS', 'POS'),
+    'chrom_pos_equal_base': ('CHR', 'start', 'start'),
+    'chrom_pos_equal_nobase': ('CHR', 'start', 'start'),
+    'chrom_pos_unequal': ('CHR', 'start', 'end'),
+    'refGene': ('chrom', 'txStart', 'txEnd'),
+    'cpgIslandExt': ('chrom', 'chromStart', 'chromEnd'),
+    'cytoBand': ('chrom', 'chromStart', 'chromEnd'),
+    'gadAll': ('chromosome', 'chromStart', 'chromEnd'),
+    'gwasCatalog': ('chrom', 'chromEnd', 'chromEnd'),
+    'targetScanS': ('chrom', 'chromStart', 'chromEnd'),
+    'hugo': ('chrom', 'chromStart', 'chromEnd'),
+    'dgv_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'abParts_IG_T_CelReceptors': ('chrom', 'chromStart', 'chromEnd'),
+    'mcCarroll_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'conrad_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'genomicSuperDups': ('chrom', 'chromStart', 'chromEnd'),
+}
+
+TFBS_CHROMS = ['1','2','3','4','5','6','7','8','9','10','11','12','13',
+    '14','15','16','17','18','19','20','21','22','X','Y']
+
+for c in TFBS_CHROMS:
+    TABLES['tfbsConsSites' + c] = (None, 'chromStart', 'chromEnd')
+
+
+"""Statement templates by query shape and the number of times each shape
+   was executed in this process
+"""
+_templates = {}
+_shape_counts = Counter()
+_stats_lock = threading.Lock()
+
+"""Returns a copy of the per-shape execution counters
+"""
+def query_counts():
+    with _stats_lock:
+        return Counter(_shape_counts)
+
+
+"""Width in bases of the start ranges a chromosome scan reads per query
+"""
+SCAN_PAGE = 1000000
+
+
+"""Smallest power of two >= n; IN lists are padded to it so that batches
+   of different sizes share a handful of statement shapes
+"""
+def padded_size(n):
+    size = 1
+    while (size < n):
+        size = size * 2
+    return size
+
+
+"""Rows of records given as (seq, row) in row order, the order MySQL
+   returns them in: several records of a table may cover a position, and
+   stages print the first one or all of them in that order rather than in
+   start order. Scans number the records in row order with
+   row_number() over (), so sources answering lookups from scanned records
+   sort them with this
+"""
+def row_order(records):
+    return [row for seq, row in sorted(records, key=lambda r: r[0])]
+
+
+"""Applies lookup where/columns arguments to rows read outside MySQL
+   table_columns are the column names of the rows, in select * order;
+   values are matched case-insensitively, as MySQL compares them
+"""
+def filter_rows(table_columns, rows, where=None, columns=None):
+    if where:
+        checks = [(table_columns.index(c),
+            set([str(v).upper() for v in values]))
+            for c, values in where.items()]
+        rows = [r for r in rows
+            if all([str(r[i]).upper() in values for i, values in checks])]
+    if columns:
+        inds = [table_columns.index(c) for c in columns]
+        rows = [tuple([r[i] for i in inds]) for r in rows]
+    return rows
+
+
+"""Reference lookups against the annotator MySQL database
+   Without conn, a connection is borrowed from the process-wide pool and
+   handed back on close()
+"""
+class MySQLSource(object):
+    def __init__(self, conn=None):
+        self.pool = None
+        if conn is None:
+            self.pool = db_pool.get_pool()
+            conn = self.pool.acquire()
+        self.conn = conn
+        self.cursor = self.conn.cursor()
+        self._columns = {}
+
+    """Column names of a table, in select * order
+    """
+    def columns(self, table):
+        if table not in self._columns:
+            self.cursor.execute('select * from ' + table + ' limit 0;')
+            self._columns[table] = [d[0] for d in self.cursor.description]
+        return self._columns[table]
+
+    def column_index(self, table, column):
+        return self.columns(table).index(column)
+
+    def count(self, table):
+        self.cursor.execute('select count(*) from ' + table + ';')
+        return int(self.cursor.fetchone()[0])
+
+    """Whether lookups on table can narrow the scan with its UCSC bin index
+    """
+    def binned(self, table):
+        return (binning.bin_columns(table) is not None and
+            'bin' in self.columns(table))
+
+    """Runs the statement of shape with bound params; build() renders the
+       template the first time the shape is seen. label names the shape in
+       the execution counters
+    """
+    def _execute(self, shape, label, build, params):
+        sql = _templates.get(shape)
+        if sql is None:
+            sql = build()
+            _templates[shape] = sql
+        with _stats_lock:
+            _shape_counts[label] += 1
+        self.cursor.execute(sql, params)
+        return self.cursor.fetchall()
+
+    def _where(self, table, where_shape):
+        chrom_col = TABLES[table][0]
+        clauses = []
+        if chrom_col is not None:
+            clauses.append(chrom_col + ' = %s')
+        for col, n in where_shape:
+            clauses.append(col + ' IN (' + ', '.join(['%s'] * n) + ')')
+        return clauses
+
+    def _params(self, table, chrom, where):
+        params = []
+        if TABLES[table][0] is not None:
+            params.append(str(chrom))
+        for col, values in sorted((where or {}).items()):
+            params.extend([str(v) for v in values])
+        return params
+
+    """All records of table covering pos, widened by offset on both sides
+       where maps column names to the values they may take
+    """
+    def lookup(self, table, chrom, pos, offset=0, where=None, columns=None,
+        limit=None):
+        chrom_col, start_col, end_col = TABLES[table]
+        pos = int(pos)
+        offset = int(offset)
+        point = (start_col == end_col and offset == 0)
+        where_shape = tuple([(c, len(v)) for c, v in sorted((where or {}).items())])
+        columns = tuple(columns) if columns else None
+        bins = []
+        if self.binned(table):
+            bins = binning.lookup_bins(pos - offset, pos + offset)
+        nbins = padded_size(len(bins)) if bins else 0
+        shape = (table, 'point' if point else 'range', where_shape, columns,
+            limit is not None, nbins)
+
+        def build():
+            clauses = self._where(table, where_shape)
+            if (nbins > 0):
+                clauses.append('bin IN (' + ', '.join(['%s'] * nbins) + ')')
+            if point:
+                clauses.append(start_col + ' = %s')
+            else:
+                clauses.append(start_col + ' <= %s AND ' + end_col + ' >= %s')
+            sql = 'select ' + (', '.join(columns) if columns else '*') + \
+                ' from ' + table + ' where ' + ' AND '.join(clauses)
+            if limit is not None:
+                sql = sql + ' limit %s'
+            return sql
+
+        params = self._params(table, chrom, where)
+        if (nbins > 0):
+            params.extend(bins + [bins[-1]] * (nbins - len(bins)))
+        if point:
+            params.append(pos)
+        else:
+            params.extend([pos + offset, pos - offset])
+        if limit is not None:
+            params.append(int(limit))
+        label = table + (' point' if point else ' range') + \
+            (' limit' if limit is not None else '') + \
+            (' binned' if nbins > 0 else '')
+        return list(self._execute(shape, label, build, params))
+
+    """Point lookups for many positions of one chromosome in one query
+       Returns a dict of position -> list of rows
+    """
+    def lookup_batch(self, table, chrom, positions, where=None,
+        columns=None):
+        chrom_col, start_col, end_col = TABLES[table]
+        positions = sorted(set([int(p) for p in positions]))
+        hits = {}
+        if len(positions) == 0:
+            return hits
+
+        n = padded_size(len(positions))
+        where_shape = tuple([(c, len(v)) for c, v in sorted((where or {}).items())])
+        columns = tuple(columns) if columns else None
+        shape = (table, 'batch', where_shape, columns, n)
+
+        def build():
+            clauses = self._where(table, where_shape)
+            clauses.append(start_col + ' IN (' + ', '.join(['%s'] * n) + ')')
+            return 'select ' + start_col + ', ' + \
+                (', '.join(columns) if columns else table + '.*') + \
+                ' from ' + table + ' where ' + ' AND '.join(clauses)
+
+        params = self._params(table, chrom, where) + positions + \
+            [positions[-1]] * (n - len(positions))
+        label = table + ' batch of ' + str(n)
+        for row in self._execute(shape, label, build, params):
+            hits.setdefault(int(row[0]), []).append(row[1:])
+        return hits
+
+    """All records of table overlapping [lo, hi] as (start, end, row)
+    """
+    def lookup_range(self, table, chrom, lo, hi):
+        chrom_col, start_col, end_col = TABLES[table]
+        lo = int(lo)
+        hi = int(hi)
+        bins = []
+        if self.binned(table):
+            bins = binning.lookup_bins(lo, hi)
+        nbins = padded_size(len(bins)) if bins else 0
+        shape = (table, 'window', nbins)
+
+        def build():
+            clauses = self._where(table, ())
+            if (nbins > 0):
+                clauses.append('bin IN (' + ', '.join(['%s'] * nbins) + ')')
+            clauses.append(start_col + ' <= %s AND ' + end_col + ' >= %s')
+            return 'select ' + start_col + ', ' + end_col + ', ' + table + \
+                '.* from ' + table + ' where ' + ' AND '.join(clauses)
+
+        params = self._params(table, chrom, None)
+        if (nbins > 0):
+            params.extend(bins + [bins[-1]] * (nbins - len(bins)))
+        params.extend([hi, lo])
+        label = table + ' window' + (' binned' if nbins > 0 else '')
+        return [(int(row[0]), int(row[1]), row[2:])
+            for row in self._execute(shape, label, build, params)]
+
+    """Streams every record of a table as (chrom, start, end, seq, row),
+       ordered by chromosome and start; seq numbers the records in the
+       order of the rows in the table (see row_order). With chrom, only the
+       records of that chromosome (see _scan_chrom)
+    """
+    def scan(self, table, chrom=None):
+        if chrom is not None:
+            yield from self._scan_chrom(table, chrom)
+            return
+
+        chrom_col, start_col, end_col = TABLES[table]
+        order = (chrom_col + ', ' if chrom_col else '') + start_col
+        cursor = self.conn.cursor(pymysql.cursors.SSCursor)
+        cursor.execute('select row_number() over (), ' + \
+            (chrom_col or '""') + ', ' + start_col + ', ' + end_col + ', ' + \
+            table + '.* from ' + table + ' order by ' + order + ';')
+        try:
+            for row in cursor:
+                yield (str(row[1]), int(row[2]), int(row[3]), int(row[0]),
+                    row[4:])
+        finally:
+            cursor.close()
+
+    """Records of one chromosome ordered by start, read SCAN_PAGE bases of
+       starts at a time with ordinary buffered queries: unlike the
+       unbuffered cursor of a full scan, this leaves the connection free
+       for other lookups between two records
+       The records a lookup on a point table matches all start at the same
+       position, so they come from one page and numbering the rows of each
+       page in row order is enough. Records of other tables are numbered
+       over the whole chromosome, which costs a read of the chromosome's
+       rows per page
+    """
+    def _scan_chrom(self, table, chrom):
+        chrom_col, start_col, end_col = TABLES[table]
+        params = self._params(table, chrom, None)
+        point = (start_col == end_col)
+
+        def build_extent():
+            clauses = self._where(table, ()) or ['1 = 1']
+            return 'select min(' + start_col + '), max(' + start_col + \
+                ') from ' + table + ' where ' + ' AND '.join(clauses)
+
+        def build_page():
+            page = start_col + ' >= %s AND ' + start_col + ' <= %s'
+            if point:
+                clauses = self._where(table, ()) + [page]
+                return 'select row_number() over (), ' + start_col + ', ' + \
+                    end_col + ', ' + table + '.* from ' + table + \
+                    ' where ' + ' AND '.join(clauses) + \
+                    ' order by ' + start_col
+            clauses = self._where(table, ()) or ['1 = 1']
+            columns = ', '.join(self.columns(table))
+            return 'select seq, ' + start_col + ', ' + end_col + ', ' + \
+                columns + ' from (select row_number() over () as seq, ' + \
+                columns + ' from ' + table + ' where ' + \
+                ' AND '.join(clauses) + ') as numbered where ' + page + \
+                ' order by ' + start_col
+
+        ((first, last),) = self._execute((table, 'extent'), table + ' extent',
+            build_extent, params)
+        if first is None:
+            return
+        numbered = 0
+        for lo in range(int(first), int(last) + 1, SCAN_PAGE):
+            rows = self._execute((table, 'page'), table + ' page',
+                build_page, params + [lo, lo + SCAN_PAGE - 1])
+            for row in rows:
+                yield (str(chrom), int(row[1]), int(row[2]),
+                    numbered + int(row[0]), row[3:])
+            if point:
+                numbered = numbered + len(rows)
+
+    def close(self):
+        if self.conn is None:
+            return
+        self.cursor.close()
+        if self.pool is not None:
+            self.pool.release(self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+
+"""Version of the reference data the configured backend serves: the
+   bundle's own version, or ReferenceVersion for the live database
+"""
+def version(backend=None):
+    backend = backend or u.config.get('ANNOTATE', 'ReferenceBackend',
+        fallback='mysql')
+    if (backend == 'bundle'):
+        import bundle
+        return bundle.open_bundle(u.config.get('ANNOTATE',
+            'ReferenceBundlePath')).version
+    return u.config.get('ANNOTATE', 'ReferenceVersion', fallback='')
+
+
+"""Raises ValueError when a pass of stages cannot open a reference
+   source per stage: every stage holds a pooled MySQL connection for the
+   whole pass, so with PoolSize below the number of stages the last ones
+   would wait PoolTimeout seconds for a connection and fail
+"""
+def check_sources(stages, backend=None):
+    backend = backend or u.config.get('ANNOTATE', 'ReferenceBackend',
+        fallback='mysql')
+    if (backend == 'mysql'):
+        db_pool.get_pool().check_capacity(len(stages))
+
+
+"""Tables that source, or a source it wraps, looks up per variant because
+   the input turned out not to be sorted
+"""
+def unsorted_tables(source):
+    tables = set()
+    while source is not None:
+        tables.update(getattr(source, 'unsorted', ()))
+        source = getattr(source, 'source', None)
+    return tables
+
+
+"""Notes in a job log, once, the tables looked up per variant because the
+   input is not sorted
+"""
+def write_unsorted_log(fh_log, tables):
+    if (len(tables) > 0):
+        fh_log.write(f"Input is not sorted; looked up per variant: " + \
+            f"{', '.join(sorted(tables))}\n")
+
+
+"""Opens the reference source selected in ann_config.ini
+   With AnnotationEngine = sweep, tables are streamed in lockstep with the
+   sorted variants (see sweep.py); otherwise tables listed in
+   PrefetchTables are read one window at a time for sorted inputs. Tables
+   listed in IndexedTables are answered from in-memory interval indexes
+   loaded once per process either way
+"""
+def connect(backend=None):
+    backend = backend or u.config.get('ANNOTATE', 'ReferenceBackend',
+        fallback='mysql')
+
+    if (backend == 'mysql'):
+        source = MySQLSource()
+    elif (backend == 'bundle'):
+        import bundle
+        source = bundle.open_bundle(u.config.get('ANNOTATE',
+            'ReferenceBundlePath'))
+    else:
+        raise ValueError(f"Unknown reference backend '{backend}'")
+
+    engine = u.config.get('ANNOTATE', 'AnnotationEngine', fallback='lookup')
+    prefetched = [t.strip() for t in u.config.get('ANNOTATE',
+        'PrefetchTables', fallback='').split(',') if t.strip()]
+    if (engine == 'sweep'):
+        import sweep
+        source = sweep.SweepSource(source)
+    elif (engine != 'lookup'):
+        raise ValueError(f"Unknown annotation engine '{engine}'")
+    elif (len(prefetched) > 0):
+        import prefetch
+        source = prefetch.WindowedSource(source, prefetched,
+            window_size=u.config.getint('ANNOTATE', 'PrefetchWindow',
+                fallback=1000000))
+
+    indexed = [t.strip() for t in u.config.get('ANNOTATE', 'IndexedTables',
+        fallback='').split(',') if t.strip()]
+    if (len(indexed) > 0):
+        import interval_index
+        source = interval_index.IndexedSource(source, indexed, key=backend)
+
+    return source
+
+### EOF
@@ -33,93 +33,167 @@ class Timer(object):
             print(f"Approximate runtime: {self.secs:.2f} seconds")
 
 
-# source: https://docs.aws.amazon.com/AmazonS3/latest/userguide/download-objects.html
-if __name__ == '__main__':
-    # Call the AnnTools pipeline
-    if len(sys.argv) > 1:
-        with Timer():
-            driver.run(sys.argv[1], 'vcf')
-
-        s3_client = boto3.client('s3')
-        bucket_name = config.get('AWS', 'ResultsBucket')
-        files = os.listdir(sys.argv[2])
-        user_id = sys.argv[3]
-        job_id = sys.argv[4]
-        user_email = sys.argv[5]
-
-        for filename in files:
-            local_path = os.path.join(sys.argv[2], filename)
-            if filename.endswith('.annot.vcf') or filename.endswith('.vcf.count.log'):
-                s3_path = f"{config.get('AWS', 'Owner')}/{user_id}/{job_id}~{filename}"
-                try:
-                    # Upload the file to S3
-                    s3_client.upload_file(local_path, bucket_name, s3_path)
-                    print(f'Successfully uploaded {filename} to s3://{bucket_name}/{s3_path}')
-                except Exception as e:
-                    print(f'Error processing file {filename}: {str(e)}')
-
-            os.remove(local_path)
+# boto3 clients of this process, created on first use and kept for later
+# jobs run by the same annotator worker
+_clients = {}
 
-        try:
-            os.rmdir(sys.argv[2])
-            print(f"The directory {sys.argv[2]} has been deleted successfully")
-        except OSError as e:
-            print(f"Error: {e.strerror}")
 
-        # update the dynamoDB table status to COMPLETED
-        # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.Python.03.html
-        try:
-            dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-            ann_table = dynamodb.Table(config.get('AWS', 'DynamoDBTable'))
-            table_fields = ann_table.get_item(Key={'job_id': job_id})
-            response = ann_table.get_item(Key={'job_id': job_id})
-            input_file_name = response['Item']['s3_key_input_file']
-            result_file_name = input_file_name[:-4] + '.annot.vcf'
-            log_file_name = input_file_name[:-4] + '.vcf.count.log'
-
-            ann_table.update_item(Key={'job_id': job_id},
-                                  UpdateExpression="set job_status = :s, s3_results_bucket = :b, s3_key_result_file = :f, s3_key_log_file = :l, complete_time = :c",
-                                  ExpressionAttributeValues={
-                                      ':s': 'COMPLETED',
-                                      ':b': bucket_name,
-                                      ':f': result_file_name,
-                                      ':l': log_file_name,
-                                      ':c': int(time.time())
-                                  },
-                                  ReturnValues="UPDATED_NEW"
-                                  )
-        except botocore.exceptions.ClientError:
-            print('error updating table.')
+def get_client(service):
+    if service not in _clients:
+        _clients[service] = boto3.client(service)
+    return _clients[service]
 
-        # Send user email notifications
-        sns = boto3.client('sns')
-        message = str({
-            'filename': str(sys.argv[1]),
-            'job_id': str(job_id),
-            'user_email': str(user_email),
-            'job_status': "COMPLETED"
 
-        })
+def get_table():
+    if 'dynamodb' not in _clients:
+        dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+        _clients['dynamodb'] = dynamodb.Table(config.get('AWS', 'DynamoDBTable'))
+    return _clients['dynamodb']
+
+
+"""Creates the clients of this process ahead of its first job; used as
+   the initializer of annotator.py worker processes
+"""
+def warm_up():
+    for service in ('s3', 'sns', 'sqs'):
+        get_client(service)
+    get_table()
+
+
+# Left in a job's directory once its results are written; the directory
+# is kept when an upload fails, and a retry uploads those results again
+# instead of annotating the input once more
+ANNOTATED_MARKER = '.annotated'
 
-        try:  # Publish SNS message
-            response = sns.publish(
-                TopicArn=config.get('AWS', 'SNSJobCompleteTopic'),
-                Message=message
-            )
-            print({
-                'send job complete message success'
-            })
-        except botocore.exceptions.ClientError as e:  # Topic not found
-            print({
-                'code': 'HTTP_500_INTERNAL_SERVER_ERROR',
-                'status': 'error',
-                'message': 'Error publishing file annotation results to sqs queue'
-            })
 
-        # Archive results to glacier vault
-        profile = helpers.get_user_profile(id=user_id)
-        if profile['role'] == 'free_user':
-            sqs = boto3.client('sqs')
+"""Annotates file_path, uploads the results found in dir_path, marks the
+   job COMPLETED, notifies the user and queues free users' results for
+   archiving
+   lease_owner, when given, must still hold the job's lease for it to be
+   marked COMPLETED
+   Returns whether the results were uploaded and the job marked COMPLETED;
+   annotator.py only acknowledges the job's message then
+"""
+# source: https://docs.aws.amazon.com/AmazonS3/latest/userguide/download-objects.html
+def run_job(file_path, dir_path, user_id, job_id, user_email, lease_owner=None):
+    marker_path = os.path.join(dir_path, ANNOTATED_MARKER)
+    if os.path.exists(marker_path):
+        print(f'Reusing the results of an earlier attempt at job {job_id}')
+    else:
+        with Timer():
+            driver.run(file_path, 'vcf')
+        open(marker_path, 'w').close()
+
+    s3_client = get_client('s3')
+    bucket_name = config.get('AWS', 'ResultsBucket')
+    files = os.listdir(dir_path)
+    uploaded = True
+
+    for filename in files:
+        local_path = os.path.join(dir_path, filename)
+        if filename.endswith('.annot.vcf') or filename.endswith('.annot.vcf.gz') or filename.endswith('.annot.vcf.gz.idx.json') or filename.endswith('.vcf.count.log'):
+            s3_path = f"{config.get('AWS', 'Owner')}/{user_id}/{job_id}~{filename}"
+            try:
+                # Upload the file to S3
+                s3_client.upload_file(local_path, bucket_name, s3_path)
+                print(f'Successfully uploaded {filename} to s3://{bucket_name}/{s3_path}')
+            except Exception as e:
+                print(f'Error processing file {filename}: {str(e)}')
+                uploaded = False
+
+    # Keep everything for the retry while any upload is missing
+    if not uploaded:
+        return False
+
+    for filename in files:
+        os.remove(os.path.join(dir_path, filename))
+    try:
+        os.rmdir(dir_path)
+        print(f"The directory {dir_path} has been deleted successfully")
+    except OSError as e:
+        print(f"Error: {e.strerror}")
+
+    # update the dynamoDB table status to COMPLETED
+    # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.Python.03.html
+    try:
+        ann_table = get_table()
+        table_fields = ann_table.get_item(Key={'job_id': job_id})
+        response = ann_table.get_item(Key={'job_id': job_id})
+        input_file_name = response['Item']['s3_key_input_file']
+        # Inputs may be x.vcf or x.vcf.gz
+        input_prefix = input_file_name[:-7] if input_file_name.endswith('.vcf.gz') else input_file_name[:-4]
+        result_file_name = input_prefix + '.annot.vcf'
+        if config.getboolean('ANNOTATE', 'CompressResults', fallback=False):
+            result_file_name = result_file_name + '.gz'
+        log_file_name = input_prefix + '.vcf.count.log'
+
+        update_expression = "set job_status = :s, s3_results_bucket = :b, s3_key_result_file = :f, s3_key_log_file = :l, complete_time = :c"
+        attribute_values = {
+            ':s': 'COMPLETED',
+            ':b': bucket_name,
+            ':f': result_file_name,
+            ':l': log_file_name,
+            ':c': int(time.time())
+        }
+        # Compressed results come with a coordinate index for region queries
+        if result_file_name.endswith('.gz'):
+            update_expression = update_expression + ", s3_key_result_index = :i"
+            attribute_values[':i'] = result_file_name + '.idx.json'
+        # The annotator's claim on the job ends with it
+        update_expression = update_expression + " remove lease_owner, lease_expiry"
+        update_args = {}
+        # Another annotator may have reclaimed the job after this one lost
+        # its lease; only the current owner completes it
+        if lease_owner is not None:
+            update_args['ConditionExpression'] = 'job_status = :running AND lease_owner = :owner'
+            attribute_values[':running'] = 'RUNNING'
+            attribute_values[':owner'] = lease_owner
+
+        ann_table.update_item(Key={'job_id': job_id},
+                              UpdateExpression=update_expression,
+                              ExpressionAttributeValues=attribute_values,
+                              ReturnValues="UPDATED_NEW",
+                              **update_args
+                              )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            print(f'Lost the lease on job {job_id}; not marking it COMPLETED')
+        else:
+            print('error updating table.')
+        return False
+
+    # Send user email notifications
+    sns = get_client('sns')
+    message = str({
+        'filename': str(file_path),
+        'job_id': str(job_id),
+        'user_email': str(user_email),
+        'job_status': "COMPLETED"
+
+    })
+
+    try:  # Publish SNS message
+        response = sns.publish(
+            TopicArn=config.get('AWS', 'SNSJobCompleteTopic'),
+            Message=message
+        )
+        print({
+            'send job complete message success'
+        })
+    except botocore.exceptions.ClientError as e:  # Topic not found
+        print({
+            'code': 'HTTP_500_INTERNAL_SERVER_ERROR',
+            'status': 'error',
+            'message': 'Error publishing file annotation results to sqs queue'
+        })
+
+    # Archive results to glacier vault
+    profile = helpers.get_user_profile(id=user_id)
+    if profile['role'] == 'free_user':
+        sqs = get_client('sqs')
+        # The job is COMPLETED by now, so a failure here is reported but
+        # does not fail the job
+        try:
             sqs.send_message(
                 QueueUrl=config.get('AWS', 'SQSArchiveQueueUrl'),
                 MessageBody=str({
@@ -130,8 +204,22 @@ if __name__ == '__main__':
             print({
                 'archive queue send message success'
             })
-        else:
-            pass
+        except botocore.exceptions.ClientError as e:
+            print({
+                'code': 'HTTP_500_INTERNAL_SERVER_ERROR',
+                'status': 'error',
+                'message': f'Error sending job {job_id} to the archive queue: {str(e)}'
+            })
+    else:
+        pass
+
+    return True
+
 
+if __name__ == '__main__':
+    # Call the AnnTools pipeline
+    # An optional sixth argument names the lease owner
+    if len(sys.argv) > 5:
+        sys.exit(0 if run_job(*sys.argv[1:7]) else 1)
     else:
         print("A valid .vcf file must be provided as input to this program.")
@@ -0,0 +1,207 @@
+# segment_map.py
+#
+# Precomputed gene location map for the Genes stage
+#
+# The location the Genes stage reports for a position (which transcripts
+# cover it, in which exon, CDS or promoter it falls and whether a CpG island
+# makes it a putative promoter) only changes where some transcript, exon,
+# CDS, promoter window or CpG island starts or ends. The builder cuts every
+# chromosome at those breakpoints, resolves each segment once with the same
+# code the stage uses against the database and stores the results:
+#
+#   starts   int64 segment starts, sorted
+#   ids      int64 index of each segment's result in values, -1 intergenic
+#   values   distinct (transcripts, INFO records, location counts)
+#
+# A lookup is then one binary search. The promoter offset is baked into the
+# map, so it must match the one the stage runs with. Transcripts are
+# resolved in the table's row order, the order MySQL returns them in, and
+# the map records the reference version it was built from: a map built
+# from other reference data is ignored.
+#
+# Build a map with:  python segment_map.py <file> [--offset 500]
+#
+##
+
+import os
+import pickle
+import argparse
+import threading
+from array import array
+from bisect import bisect_right
+from collections import Counter
+
+import reference
+import annotate as ann
+from interval_index import IntervalIndex
+
+FORMAT_VERSION = 2
+CPG_COLUMNS = ('chrom', 'chromStart', 'chromEnd', 'name')
+
+
+"""Positions where the location of a transcript can change: the first
+   position of every range the Genes stage tests and the one after its end
+"""
+def breakpoints(row, promoter_offset):
+    txStart = int(row[4])
+    txEnd = int(row[5])
+    cdsStart = int(row[6])
+    cdsEnd = int(row[7])
+    ranges = [(txStart - promoter_offset, txStart),
+        (txEnd, txEnd + promoter_offset), (cdsStart, cdsEnd)]
+    exonsSt = str(row[9].decode('utf-8')).split(',')
+    exonsEn = str(row[10].decode('utf-8')).split(',')
+    for e in range(0, int(row[8])):
+        ranges.append((int(exonsSt[e]), int(exonsEn[e])))
+
+    points = []
+    for (lo, hi) in ranges:
+        points.append(lo)
+        points.append(hi + 1)
+    return points
+
+
+"""Builds the map of table and cpgIslandExt read from source and writes
+   it to path
+"""
+def build_segment_map(source, path, table='refGene', promoter_offset=500,
+    version=None):
+    cpg_columns = source.columns('cpgIslandExt')
+    cpgs = {}
+    for (chrom, start, end, seq, row) in source.scan('cpgIslandExt'):
+        cpgs.setdefault(chrom, []).append((seq, (start, end,
+            reference.filter_rows(cpg_columns, [row], columns=CPG_COLUMNS)[0])))
+    cpgs = dict([(chrom, reference.row_order(records))
+        for chrom, records in cpgs.items()])
+
+    transcripts = {}
+    for (chrom, start, end, seq, row) in source.scan(table):
+        transcripts.setdefault(chrom, []).append((seq,
+            (start - promoter_offset, end + promoter_offset, row)))
+    transcripts = dict([(chrom, reference.row_order(records))
+        for chrom, records in transcripts.items()])
+
+    smap = {
+        'format_version': FORMAT_VERSION,
+        'reference_version': str(version or reference.version()),
+        'table': table,
+        'promoter_offset': promoter_offset,
+        'values': [],
+        'chroms': {}
+    }
+    value_ids = {}
+
+    for chrom, records in transcripts.items():
+        print(f"Segmenting {chrom} . . .")
+        genes = IntervalIndex(records)
+        islands = IntervalIndex(cpgs.get(chrom, []))
+        cpg_at = lambda p: ann.getFirst(islands.overlapping(p, p))
+
+        points = set()
+        for (lo, hi, row) in records:
+            points.update(breakpoints(row, promoter_offset))
+        for (lo, hi, row) in cpgs.get(chrom, []):
+            points.update([lo, hi + 1])
+
+        starts = array('q')
+        ids = array('q')
+        for p in sorted(points):
+            result = ann.resolveGeneLocation(genes.overlapping(p, p), p,
+                cpg_at, promoter_offset=promoter_offset)
+            vid = -1
+            if result is not None:
+                key = (result[0], tuple(result[1]),
+                    tuple(sorted(result[2].items())))
+                if key not in value_ids:
+                    value_ids[key] = len(smap['values'])
+                    smap['values'].append(key)
+                vid = value_ids[key]
+            # Neighbouring segments with the same location are merged
+            if (len(ids) > 0 and ids[-1] == vid):
+                continue
+            starts.append(p)
+            ids.append(vid)
+
+        smap['chroms'][chrom] = (starts.tobytes(), ids.tobytes())
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fh:
+        pickle.dump(smap, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    return smap
+
+
+"""Reader for a segment map file
+"""
+class SegmentMap(object):
+    def __init__(self, path):
+        with open(path, 'rb') as fh:
+            smap = pickle.load(fh)
+        if (smap.get('format_version') != FORMAT_VERSION):
+            raise ValueError(f"Unsupported segment map format in '{path}'")
+
+        self.path = path
+        self.version = smap['reference_version']
+        self.table = smap['table']
+        self.promoter_offset = smap['promoter_offset']
+        self.values = smap['values']
+        self.chroms = {}
+        for chrom, (starts, ids) in smap['chroms'].items():
+            a_starts = array('q')
+            a_starts.frombytes(starts)
+            a_ids = array('q')
+            a_ids.frombytes(ids)
+            self.chroms[chrom] = (a_starts, a_ids)
+
+    """Same result as annotate.resolveGeneLocation for the transcripts
+       covering pos: None when intergenic
+    """
+    def lookup(self, chrom, pos):
+        segments = self.chroms.get(chrom)
+        if segments is None:
+            return None
+        starts, ids = segments
+        i = bisect_right(starts, int(pos)) - 1
+        if (i < 0 or ids[i] == -1):
+            return None
+        transcripts, info, counts = self.values[ids[i]]
+        return (transcripts, list(info), Counter(dict(counts)))
+
+
+_maps = {}
+_maps_lock = threading.Lock()
+
+"""Returns the process-wide reader for the segment map at path, or None
+   when it was built from another reference version than the one in use:
+   a stale map would report the genes of the old tables
+"""
+def open_segment_map(path):
+    with _maps_lock:
+        if path not in _maps:
+            smap = SegmentMap(path)
+            if (smap.version != str(reference.version())):
+                print(f"Ignoring segment map {path}: built for reference " + \
+                    f"version {smap.version}, not {reference.version()}")
+                smap = None
+            _maps[path] = smap
+        return _maps[path]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build the gene location map used by the Genes stage')
+    parser.add_argument('path', help='segment map file to create')
+    parser.add_argument('--offset', type=int, default=500,
+        help='promoter offset the Genes stage runs with')
+    parser.add_argument('--version', help='reference data version label')
+    args = parser.parse_args()
+
+    source = reference.connect()
+    try:
+        smap = build_segment_map(source, args.path,
+            promoter_offset=args.offset, version=args.version)
+    finally:
+        source.close()
+    print(f"Segment map {smap['reference_version']} written to {args.path}")
+
+### EOF
@@ -0,0 +1,227 @@
+# shard.py
+#
+# Sharded parallel annotation
+#
+# The data lines of a VCF are split into shards, either one per chromosome
+# or one per fixed-size position range of a chromosome, and every shard is
+# annotated by a worker process with its own set of stages. Shards go to
+# and from the workers as temporary files (under TMPDIR), so neither
+# the input nor the annotated lines are held in memory; the annotated
+# shards are merged back in their original order around the untouched
+# header, and the stage counters of all shards are summed before
+# .count.log is written.
+#
+##
+
+import os
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import annotate as ann
+import bgzf
+import reference
+import variant_cache
+
+SHARD_MODES = ['chrom', 'range']
+
+
+"""Shard a data line belongs to: its chromosome, or its chromosome and
+   the shard_size wide position range it falls into
+"""
+def shard_key(fields, mode='chrom', shard_size=10000000):
+    chrom = fields[0].strip()
+    if (mode == 'chrom'):
+        return (chrom, 0)
+    elif (mode == 'range'):
+        return (chrom, int(fields[1].strip()) // shard_size)
+    raise ValueError(f"Unknown shard mode '{mode}'")
+
+
+# Shard files a process keeps open at once while splitting the input;
+# range shards of a whole genome can outnumber the allowed descriptors
+MAX_OPEN_SHARDS = 256
+
+
+"""Annotates the data lines of one shard file into another in a worker
+   process
+   Returns the counters of every stage, the variant cache hits and misses,
+   the lines and lookups of the in-job memo and the tables looked up per
+   variant because the input is not sorted
+"""
+def annotate_shard(task):
+    stage_factory, format, in_path, out_path, chunk_size, sep, workers = task
+    stages = stage_factory(format=format)
+    ann.openStages(stages)
+
+    pool = None
+    if (workers > 1 and len(stages) > 1):
+        pool = ThreadPoolExecutor(max_workers=workers)
+    cache = variant_cache.open_cache(stages)
+    memo = variant_cache.open_memo()
+    inds = ann.getFormatSpecificIndices(format=format)
+
+    fh = open(in_path)
+    fh_out = open(out_path, 'w')
+    try:
+        while True:
+            chunk = [ann.Variant(ann.splitLine(line.rstrip('\n'), sep=sep), inds)
+                for line in itertools.islice(fh, chunk_size)]
+            if (len(chunk) == 0):
+                break
+            ann.annotateChunk(stages, chunk, pool=pool, cache=cache,
+                memo=memo)
+            fh_out.writelines([variant.line() + '\n' for variant in chunk])
+    finally:
+        fh.close()
+        fh_out.close()
+        if pool is not None:
+            pool.shutdown()
+        for stage in stages:
+            stage.close()
+        if cache is not None:
+            cache.close()
+
+    cache_stats = None
+    if cache is not None:
+        cache_stats = (cache.hits, cache.misses)
+    memo_stats = None
+    if memo is not None:
+        memo_stats = (memo.lines, memo.lookups)
+    unsorted = set().union(*[stage.unsorted for stage in stages])
+    return ([stage.counts for stage in stages], cache_stats, memo_stats,
+        unsorted)
+
+
+"""Annotates vcf into outfile on a pool of processes
+   stage_factory(format=...) must be a module level function returning a
+   new list of stages; every worker builds its own. Output lines and
+   .count.log are the same as those of annotate.runStages
+"""
+def run_sharded(vcf, outfile, stage_factory, logfile, logmode='a',
+    format='vcf', mode='chrom', shard_size=10000000, processes=None,
+    chunk_size=2000, sep='\t', workers=0):
+
+    tmpdir = tempfile.mkdtemp(prefix='shards.')
+    try:
+        results = _run_shards(vcf, outfile, stage_factory, format, mode,
+            shard_size, processes, chunk_size, sep, workers, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    # Stages only log their counters, so summing them over the shards
+    # gives the same .count.log as a single pass
+    stages = stage_factory(format=format)
+    hits = 0
+    misses = 0
+    lines = 0
+    lookups = 0
+    unsorted = set()
+    for (counts, cache_stats, shard_memo, shard_unsorted) in results:
+        for stage, c in zip(stages, counts):
+            stage.counts.update(c)
+        if cache_stats is not None:
+            hits = hits + cache_stats[0]
+            misses = misses + cache_stats[1]
+        if shard_memo is not None:
+            lines = lines + shard_memo[0]
+            lookups = lookups + shard_memo[1]
+        unsorted.update(shard_unsorted)
+
+    fh_log = open(logfile, logmode)
+    for stage in stages:
+        stage.write_log(fh_log)
+    if (lines > 0):
+        variant_cache.write_memo_log(fh_log, lines, lookups)
+    if (hits + misses > 0):
+        variant_cache.write_log(fh_log, hits, misses)
+    reference.write_unsorted_log(fh_log, unsorted)
+    fh_log.close()
+
+
+"""Splits vcf into shard files in tmpdir, annotates them on a pool of
+   processes and merges them into outfile
+   Returns the results of annotate_shard for every shard
+"""
+def _run_shards(vcf, outfile, stage_factory, format, mode, shard_size,
+    processes, chunk_size, sep, workers, tmpdir):
+
+    # Header lines are kept as strings, data lines as the number of the
+    # shard they were assigned to; a shard's lines keep their order in its
+    # file
+    layout = []
+    numbers = {}
+    sizes = []
+    handles = {}
+    fh = bgzf.open_input(vcf)
+    for line in fh:
+        line = line.strip()
+        if (len(line) == 0):
+            continue
+
+        if ann.isHeader(line):
+            layout.append(line)
+            continue
+
+        key = shard_key(line.split(sep, 2), mode=mode, shard_size=shard_size)
+        n = numbers.get(key)
+        if n is None:
+            n = numbers[key] = len(sizes)
+            sizes.append(0)
+        fh_shard = handles.get(n)
+        if fh_shard is None:
+            if (len(handles) >= MAX_OPEN_SHARDS):
+                for h in handles.values():
+                    h.close()
+                handles.clear()
+            fh_shard = handles[n] = open(_shard_path(tmpdir, n, 'in'), 'a')
+        fh_shard.write(line + '\n')
+        layout.append(n)
+        sizes[n] = sizes[n] + 1
+    fh.close()
+    for h in handles.values():
+        h.close()
+
+    # Largest shards first, so a big chromosome does not start last
+    order = sorted(range(len(sizes)), key=lambda n: -sizes[n])
+    tasks = [(stage_factory, format, _shard_path(tmpdir, n, 'in'),
+        _shard_path(tmpdir, n, 'out'), chunk_size, sep, workers)
+        for n in order]
+    processes = min(processes or os.cpu_count() or 1, max(1, len(tasks)))
+
+    if (processes > 1):
+        pool = multiprocessing.Pool(processes=processes)
+        try:
+            results = pool.map(annotate_shard, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [annotate_shard(task) for task in tasks]
+
+    # A shard's output is closed after its last line, so sorted input only
+    # has one open at a time
+    readers = {}
+    left = list(sizes)
+    fh_out = bgzf.open_output(outfile)
+    for entry in layout:
+        if isinstance(entry, str):
+            fh_out.write(entry + '\n')
+            continue
+        reader = readers.get(entry)
+        if reader is None:
+            reader = readers[entry] = open(_shard_path(tmpdir, entry, 'out'))
+        fh_out.write(reader.readline())
+        left[entry] = left[entry] - 1
+        if (left[entry] == 0):
+            readers.pop(entry).close()
+    fh_out.close()
+    return results
+
+
+def _shard_path(tmpdir, n, kind):
+    return os.path.join(tmpdir, f'{n}.{kind}.vcf')
+
+### EOF
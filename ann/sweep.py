@@ -0,0 +1,145 @@
+# sweep.py
+#
+# Sort-merge annotation engine for position-sorted VCFs
+#
+# With AnnotationEngine = sweep, stages no longer query the reference for
+# every variant. Each table a stage reads is streamed once per chromosome,
+# ordered by start, in lockstep with the sorted variants, the way bedtools
+# intersect does on sorted inputs: records whose start the sweep line has
+# reached enter an active heap ordered by end, and leave it once the sweep
+# line has passed their end. The active records are exactly the ones that
+# overlap the current variant, so a stage costs O(n + m) for n variants and
+# m records and holds only the records around the sweep line in memory.
+#
+# Stages are unchanged: they still call lookup() and apply the rows they
+# get, so the INFO fields are written by the same code. Records come back
+# in the order of the rows in the table, as from MySQL (see
+# reference.row_order).
+#
+# A lookup behind the sweep line (unsorted input) switches the table back
+# to per-variant lookups of the wrapped source for the rest of the job, which
+# the job log notes.
+#
+##
+
+from heapq import heappush, heappop
+
+import reference
+
+
+"""Sweep over the records of one table on one chromosome, for lookups
+   widened by a fixed offset
+"""
+class _Sweep(object):
+    def __init__(self, chrom, offset, records):
+        self.chrom = chrom
+        self.offset = offset
+        self.records = records
+        self.next = next(self.records, None)
+        self.active = []
+        self.pos = None
+
+    """Records overlapping [pos - offset, pos + offset]; pos may not
+       decrease between calls
+    """
+    def overlapping(self, pos):
+        lo = pos - self.offset
+        hi = pos + self.offset
+        while (self.next is not None and self.next[1] <= hi):
+            chrom, start, end, seq, row = self.next
+            if (end >= lo):
+                heappush(self.active, (end, seq, row))
+            self.next = next(self.records, None)
+        while (len(self.active) > 0 and self.active[0][0] < lo):
+            heappop(self.active)
+        self.pos = pos
+        return reference.row_order([(seq, row)
+            for (end, seq, row) in self.active])
+
+    def close(self):
+        self.records.close()
+
+
+class SweepSource(object):
+    def __init__(self, source):
+        self.source = source
+        self.sweeps = {}
+        self.passed = {}
+        self.unsorted = set()
+
+    def columns(self, table):
+        return self.source.columns(table)
+
+    def column_index(self, table, column):
+        return self.source.column_index(table, column)
+
+    def count(self, table):
+        return self.source.count(table)
+
+    """Sweep of table over chrom able to answer pos, started when the
+       variants reach a new chromosome; None once the table turned out to
+       be read out of order
+    """
+    def _sweep(self, table, chrom, pos, offset):
+        key = (table, offset)
+        sweep = self.sweeps.get(key)
+        if (sweep is not None and sweep.chrom == chrom and sweep.pos <= pos):
+            return sweep
+
+        passed = self.passed.setdefault(key, set())
+        if (sweep is not None and (sweep.chrom == chrom or chrom in passed)):
+            self.unsorted.add(table)
+            self._drop(table)
+            return None
+        if sweep is not None:
+            passed.add(sweep.chrom)
+            sweep.close()
+
+        sweep = _Sweep(chrom, offset, self.source.scan(table, chrom=chrom))
+        self.sweeps[key] = sweep
+        return sweep
+
+    def _drop(self, table):
+        for key in [k for k in self.sweeps if k[0] == table]:
+            self.sweeps.pop(key).close()
+
+    def lookup(self, table, chrom, pos, offset=0, where=None, columns=None,
+        limit=None):
+        sweep = None
+        if table not in self.unsorted:
+            sweep = self._sweep(table, chrom, int(pos), int(offset))
+        if sweep is None:
+            return self.source.lookup(table, chrom, pos, offset=offset,
+                where=where, columns=columns, limit=limit)
+
+        rows = reference.filter_rows(self.columns(table),
+            sweep.overlapping(int(pos)), where, columns)
+        if limit is not None:
+            rows = rows[:limit]
+        return rows
+
+    def lookup_batch(self, table, chrom, positions, where=None,
+        columns=None):
+        if table in self.unsorted:
+            return self.source.lookup_batch(table, chrom, positions,
+                where=where, columns=columns)
+
+        hits = {}
+        for pos in sorted(set([int(p) for p in positions])):
+            rows = self.lookup(table, chrom, pos, where=where, columns=columns)
+            if (len(rows) > 0):
+                hits[pos] = rows
+        return hits
+
+    def lookup_range(self, table, chrom, lo, hi):
+        return self.source.lookup_range(table, chrom, lo, hi)
+
+    def scan(self, table, chrom=None):
+        return self.source.scan(table, chrom=chrom)
+
+    def close(self):
+        for key in list(self.sweeps):
+            self.sweeps.pop(key).close()
+        self.source.close()
+
+### EOF
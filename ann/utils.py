@@ -13,39 +13,75 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
+import threading
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
+from configparser import ConfigParser
+
+# Annotator configuration lives next to this module
+config = ConfigParser()
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)),
+    'ann_config.ini'))
+
+_secret_cache = {'secret': None, 'expires': 0}
+_secret_lock = threading.Lock()
+
+"""Get the reference database credentials from AWS Secrets Manager
+   The secret is cached for SecretTTL seconds; refresh forces a new fetch
+"""
+def get_db_secret(refresh=False):
+    with _secret_lock:
+        if (refresh or _secret_cache['secret'] is None or
+            time.time() >= _secret_cache['expires']):
+            AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+                ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+
+            # Get RDS secret from AWS Secrets Manager
+            asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+            try:
+                asm_response = asm.get_secret_value(
+                    SecretId='rds/anntools_database')
+                rds_secret = json.loads(asm_response['SecretString'])
+            except ClientError as e:
+                print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+                raise e
+
+            _secret_cache['secret'] = rds_secret
+            _secret_cache['expires'] = time.time() + \
+                config.getint('DATABASE', 'SecretTTL', fallback=3600)
+        return _secret_cache['secret']
+
 
 """Get connection to reference database
+   Credentials come from the secret cache; when the database rejects them
+   (e.g. after the secret was rotated) they are fetched again once
 """
 def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
-
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
-    try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
-
-    # Extract database connection parameters
-    rds_host = rds_secret['host']
-    mysql_port = rds_secret['port']
-    username = rds_secret['username']
-    password = rds_secret['password']
-    database_name = 'annotator'
-
-    # Return a connection to the database
-    return pymysql.connect(
-        host=rds_host,
-        port=mysql_port,
-        user=username,
-        passwd=password,
-        db=database_name)
+    for attempt in range(2):
+        rds_secret = get_db_secret(refresh=(attempt > 0))
+
+        # Extract database connection parameters
+        rds_host = rds_secret['host']
+        mysql_port = rds_secret['port']
+        username = rds_secret['username']
+        password = rds_secret['password']
+        database_name = 'annotator'
+
+        # Return a connection to the database
+        try:
+            return pymysql.connect(
+                host=rds_host,
+                port=mysql_port,
+                user=username,
+                passwd=password,
+                db=database_name)
+        except pymysql.err.OperationalError as e:
+            # 1045: access denied
+            if (attempt > 0 or len(e.args) == 0 or e.args[0] != 1045):
+                raise e
+            print("Reference database rejected cached credentials; refreshing")
 
 
 """Column inices for pileup and VCF
@@ -0,0 +1,209 @@
+# variant_cache.py
+#
+# Persistent cache of annotation lookups, shared by all jobs on a host
+#
+# Users keep uploading overlapping VCFs, so most variants of a job have
+# often been annotated minutes earlier. The cache maps a normalized variant
+# (chromosome without "chr", position, REF, ALT), the reference data
+# version and the signature of the stage list to the lookup results of
+# every stage. Stages still apply the cached results, so INFO fields and
+# .count.log are exactly what a fresh lookup produces.
+#
+# Entries live in a SQLite file; once the cache holds more than
+# VariantCacheSize variants, the least recently used ones are evicted down
+# to EVICT_TO of that size. Counting the entries is a scan of the table, so
+# each job keeps a running estimate and only counts once the estimate
+# passes the limit.
+#
+# Within a job, VariantMemo does the same in memory for variants repeated
+# on several lines, so each distinct variant is looked up once per job.
+#
+##
+
+import time
+import pickle
+import sqlite3
+import hashlib
+from collections import OrderedDict
+
+import reference
+import utils as u
+
+# SQLite limits the number of bound parameters of a statement
+MAX_PARAMS = 500
+
+# Share of max_entries the cache is brought down to by an eviction, which
+# leaves room for the puts until the next count
+EVICT_TO = 0.9
+
+
+"""Normalized key of a Variant: chromosome without "chr", position, REF
+   and ALT
+"""
+def variant_key(variant):
+    return '\t'.join([variant.chrom, str(variant.pos), variant.ref,
+        variant.alt])
+
+
+"""Cache signature of a stage list run against reference data version
+"""
+def cache_signature(stages, version):
+    text = str(version) + '|' + '|'.join([s.signature() for s in stages])
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+class VariantCache(object):
+    def __init__(self, path, signature, max_entries=1000000):
+        self.path = path
+        self.signature = signature
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS variants ' + \
+            '(key TEXT PRIMARY KEY, value BLOB, used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS variants_used ' + \
+            'ON variants (used)')
+        self.db.commit()
+
+        # Entries as of the last count plus those put since; an overestimate
+        # when puts replace entries, an underestimate when other jobs put
+        (self.entries,) = self.db.execute(
+            'SELECT COUNT(*) FROM variants').fetchone()
+
+    def key(self, variant):
+        return self.signature + '\t' + variant_key(variant)
+
+    """Cached lookup results of the keys found, by key
+    """
+    def get_many(self, keys):
+        found = {}
+        unique = list(set(keys))
+        for i in range(0, len(unique), MAX_PARAMS):
+            batch = unique[i:i + MAX_PARAMS]
+            marks = ','.join(['?'] * len(batch))
+            for key, value in self.db.execute('SELECT key, value FROM ' + \
+                'variants WHERE key IN (' + marks + ')', batch):
+                found[key] = pickle.loads(value)
+            self.db.execute('UPDATE variants SET used = ? WHERE key IN (' + \
+                marks + ')', [time.time()] + batch)
+        self.db.commit()
+
+        for key in keys:
+            if key in found:
+                self.hits = self.hits + 1
+            else:
+                self.misses = self.misses + 1
+        return found
+
+    """Stores (key, lookup results) pairs and, once the cache holds more
+       than max_entries, evicts the least recently used entries
+    """
+    def put_many(self, items):
+        now = time.time()
+        self.db.executemany('INSERT OR REPLACE INTO variants ' + \
+            '(key, value, used) VALUES (?, ?, ?)',
+            [(key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), now)
+                for key, value in items])
+
+        self.entries = self.entries + len(items)
+        if (self.entries > self.max_entries):
+            (count,) = self.db.execute(
+                'SELECT COUNT(*) FROM variants').fetchone()
+            if (count > self.max_entries):
+                keep = int(self.max_entries * EVICT_TO)
+                self.db.execute('DELETE FROM variants WHERE key IN ' + \
+                    '(SELECT key FROM variants ORDER BY used LIMIT ?)',
+                    (count - keep,))
+                count = keep
+            self.entries = count
+        self.db.commit()
+
+    def write_log(self, fh_log):
+        write_log(fh_log, self.hits, self.misses)
+
+    def close(self):
+        self.db.close()
+
+
+"""Bounded memo of the lookup results of the variants seen in one job
+   Merged and multi-sample VCFs repeat the same variant on many lines;
+   only the first line of a variant is looked up, the others get its
+   results. The least recently used variants are forgotten beyond
+   max_entries
+"""
+class VariantMemo(object):
+    def __init__(self, max_entries=100000):
+        self.max_entries = max(1, int(max_entries))
+        self.entries = OrderedDict()
+        self.lines = 0
+        self.lookups = 0
+
+    def key(self, variant):
+        return variant_key(variant)
+
+    """Memoized lookup results of the keys found, by key
+    """
+    def get_many(self, keys):
+        self.lines = self.lines + len(keys)
+        found = {}
+        for key in keys:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                found[key] = self.entries[key]
+        return found
+
+    """Stores (key, lookup results) pairs of variants just looked up
+    """
+    def put_many(self, items):
+        for key, value in items:
+            self.lookups = self.lookups + 1
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+        while (len(self.entries) > self.max_entries):
+            self.entries.popitem(last=False)
+
+    def write_log(self, fh_log):
+        write_memo_log(fh_log, self.lines, self.lookups)
+
+
+"""Writes how many data lines repeated a variant already looked up
+"""
+def write_memo_log(fh_log, lines, lookups):
+    repeated = lines - lookups
+    ratio = (repeated / float(lines)) * 100 if lines > 0 else 0.0
+    fh_log.write(f"Duplicate variants: {str(repeated)} of {str(lines)} " + \
+        f"lines ({str(ratio)}%)\n")
+
+
+"""Writes the cache hit rate to the job log
+"""
+def write_log(fh_log, hits, misses):
+    total = hits + misses
+    ratio = (hits / float(total)) * 100 if total > 0 else 0.0
+    fh_log.write(f"Annotation cache: {str(hits)} hits, " + \
+        f"{str(misses)} misses ({str(ratio)}%)\n")
+
+
+"""Opens the cache configured for stages, or returns None when
+   VariantCachePath is not set
+"""
+def open_cache(stages):
+    path = u.config.get('ANNOTATE', 'VariantCachePath', fallback='')
+    if not path:
+        return None
+    return VariantCache(path, cache_signature(stages, reference.version()),
+        max_entries=u.config.getint('ANNOTATE', 'VariantCacheSize',
+            fallback=1000000))
+
+"""Opens the in-job memo, or returns None when VariantMemoSize is 0
+"""
+def open_memo():
+    size = u.config.getint('ANNOTATE', 'VariantMemoSize', fallback=0)
+    if (size <= 0):
+        return None
+    return VariantMemo(max_entries=size)
+
+### EOF
@@ -87,12 +87,16 @@ class Config(object):
   AWS_S3_KEY_PREFIX = "ishaz/"
   AWS_S3_ACL = "private"
   AWS_S3_ENCRYPTION = "AES256"
+  # Largest compressed byte range a region query reads from a result
+  AWS_S3_REGION_MAX_BYTES = 16 * 1024 * 1024
 
   AWS_GLACIER_VAULT = "mpcs-cc"
 
   # Change the ARNs below to reflect your SNS topics
   AWS_SNS_JOB_REQUEST_TOPIC = \
     "arn:aws:sns:us-east-1:659248683008:ishaz_job_requests"
+  AWS_SNS_PREMIUM_JOB_REQUEST_TOPIC = \
+    "arn:aws:sns:us-east-1:659248683008:ishaz_job_requests_premium"
   AWS_SNS_JOB_COMPLETE_TOPIC = \
     "arn:aws:sns:us-east-1:659248683008:ishaz_job_results"
   AWS_SNS_RESTORE_TOPIC = \
@@ -8,9 +8,13 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import re
+import sys
 import uuid
 import time
 import json
+import zlib
+import functools
 import pytz
 from datetime import datetime
 
@@ -116,7 +120,8 @@ def create_annotation_job_request():
     uu_id, file_name = uu_id_and_file_name.split('~')
     user_id = session['primary_identity']  # Globus Identity ID is a UUID
 
-    if not file_name.endswith('.vcf'):  # File still gets uploaded though
+    # Plain or gzip/bgzip compressed VCFs
+    if not (file_name.endswith('.vcf') or file_name.endswith('.vcf.gz')):  # File still gets uploaded though
         abort(405)
 
     if uu_id == None or file_name == None or file_name == "":
@@ -146,12 +151,17 @@ def create_annotation_job_request():
         else:
             abort(500)
 
-    # Send message to request queue
+    # Send message to request queue; premium users' jobs go to a queue of
+    # their own, which the annotator reads ahead of the free users' queue
+    if session.get('role') == 'premium_user':
+        topic = app.config['AWS_SNS_PREMIUM_JOB_REQUEST_TOPIC']
+    else:
+        topic = app.config['AWS_SNS_JOB_REQUEST_TOPIC']
     try:
         user_email = session['email']
         data['user_email'] = str(user_email)
         sns.publish(
-            TopicArn=app.config['AWS_SNS_JOB_REQUEST_TOPIC'],
+            TopicArn=topic,
             Message=str(data)
         )
     except botocore.exceptions.ClientError as e:  # Topic not found
@@ -269,6 +279,70 @@ def annotation_log(id):
     return render_template('view_log.html', job_id=id, log_file_contents=content)
 
 
+"""Display the annotated variants of a region of a job's results
+Only the blocks of the BGZF result holding the region are read, with a
+ranged S3 GET driven by the coordinate index the annotator uploads next
+to compressed results
+"""
+
+
+@app.route('/annotations/<id>/region', methods=['GET'])
+@authenticated
+def annotation_region(id):
+    bucket_name = app.config['AWS_S3_RESULTS_BUCKET']
+
+    try:
+        ann_table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+        response = ann_table.query(
+            KeyConditionExpression=Key('job_id').eq(id)
+        )
+        annotation = response['Items'][0]
+
+    except botocore.exceptions.ClientError:
+        abort(500)
+
+    if annotation['user_id'] != session['primary_identity']:
+        abort(403)
+
+    # Only compressed results come with an index
+    if annotation['job_status'] != 'COMPLETED' or 's3_key_result_index' not in annotation:
+        abort(404)
+
+    if (session['role'] == 'free_user' and time.time() - float(annotation['complete_time']) >= app.config['FREE_USER_DATA_RETENTION']):
+        abort(403)
+
+    region = request.args.get('region', '').strip()
+    columns = None
+    lines = None
+    error = None
+    if region:
+        parsed = parse_region(region)
+        if parsed is None:
+            error = "Regions are written as chrom:start-end, e.g. chr1:1000000-1100000"
+        else:
+            try:
+                index = get_result_index(bucket_name, annotation['s3_key_result_index'])
+                byte_range = region_byte_range(index, *parsed)
+                columns = index['columns']
+                lines = []
+                if byte_range is None:
+                    pass
+                elif byte_range[1] - byte_range[0] > app.config['AWS_S3_REGION_MAX_BYTES']:
+                    error = "This region is too large to display; please download the results file"
+                    lines = None
+                else:
+                    object = s3.Object(bucket_name, annotation['s3_key_result_file'])
+                    content = object.get(Range=f"bytes={byte_range[0]}-{byte_range[1] - 1}")['Body'].read()
+                    lines = region_lines(content, byte_range[2], *parsed)
+
+            except botocore.exceptions.ClientError as e:
+                app.logger.info(e)
+                abort(500)
+
+    return render_template('annotation_region.html', job_id=id, region=region,
+                           columns=columns, lines=lines, error=error)
+
+
 """Subscription management handler
 """
 
@@ -358,6 +432,69 @@ def create_presigned_download_url(result_object_key):
     return response
 
 
+"""Parses chrom:start-end (or chrom:pos, or chrom) into (chrom, start, end)
+"""
+def parse_region(region):
+    match = re.match(r'^([^:\s]+)(?::([\d,]+)(?:-([\d,]+))?)?$', region)
+    if match is None:
+        return None
+    chrom = match.group(1)
+    start = int(match.group(2).replace(',', '')) if match.group(2) else 0
+    end = int(match.group(3).replace(',', '')) if match.group(3) else \
+        (start if match.group(2) else sys.maxsize)
+    if end < start:
+        return None
+    return (chrom, start, end)
+
+
+# Result indexes never change once uploaded
+@functools.lru_cache(maxsize=64)
+def get_result_index(bucket_name, s3_key):
+    object = s3.Object(bucket_name, s3_key)
+    return json.loads(object.get()['Body'].read().decode())
+
+
+"""Compressed byte range [first, last) holding the lines of a region and
+the offset of the first of them in its uncompressed block, or None when
+no line of the region is in the results
+"""
+def region_byte_range(index, chrom, start, end):
+    bins = index['chroms'].get(chrom)
+    if bins is None:
+        # Results keep the chromosome names of the input, with or without "chr"
+        other = chrom[3:] if chrom.startswith('chr') else 'chr' + chrom
+        bins = index['chroms'].get(other, {})
+    width = index['bin_width']
+    entries = [entry for key, entry in bins.items()
+               if start // width <= int(key) <= end // width]
+    if len(entries) == 0:
+        return None
+    first = min([entry[:2] for entry in entries])
+    last = max([entry[2] for entry in entries])
+    return (first[0], last, first[1])
+
+
+"""Lines of the region in content, a run of BGZF blocks whose first line
+starts skip bytes into the first block
+"""
+def region_lines(content, skip, chrom, start, end):
+    data = bytearray()
+    while content:
+        decompressor = zlib.decompressobj(31)
+        data.extend(decompressor.decompress(content))
+        content = decompressor.unused_data
+
+    chroms = (chrom, chrom[3:] if chrom.startswith('chr') else 'chr' + chrom)
+    lines = []
+    for line in data[skip:].decode().split('\n'):
+        fields = line.split('\t', 2)
+        if len(fields) < 3 or fields[0].strip() not in chroms or not fields[1].strip().isdigit():
+            continue
+        if start <= int(fields[1]) <= end:
+            lines.append(line)
+    return lines
+
+
 def get_chicago_time(timestamp):
     utc_time = datetime.utcfromtimestamp(float(timestamp)).replace(tzinfo=pytz.utc)
     chicago_tz = pytz.timezone('America/Chicago')